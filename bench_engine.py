@@ -0,0 +1,438 @@
+"""Benchmark suite for payment_engine.
+
+Times the whole CLI (main() in a subprocess, with its peak RSS), the parse
+stage and the apply stage separately, plus focused micro-benchmarks, on a
+workload from gen_transactions. Results can be saved as JSON and compared
+with a run from another commit.
+
+Run: python3 bench_engine.py [rows] [--json out.json] [--compare old.json]
+"""
+import json, os, platform, random, resource, subprocess, sys, tempfile, threading, time, tracemalloc
+from argparse import ArgumentParser
+from decimal import Decimal
+from csv import Sniffer, DictReader
+
+import payment_engine as engine
+import engine_kernel, engine_store, engine_view, engine_wal, engine_worker
+import gen_transactions
+
+BENCHMARKS = {}
+# Benchmarks that make their own data, so need no workload file
+STANDALONE = {'spill', 'startup'}
+results = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+def record(name: str, value: float, unit: str):
+    results[name] = {'value': value, 'unit': unit}
+    print(f'{name}: {value:,.{0 if value >= 100 else 3}f} {unit}')
+
+def dictreader_rows(path: str):
+    """The original two-open Sniffer/DictReader ingestion, for comparison."""
+    with open(path, newline='') as csvfile:
+        has_header = Sniffer().has_header(csvfile.read(1024))
+    with open(path, newline='') as csvfile:
+        reader = DictReader(csvfile, fieldnames=None if has_header else list(engine.FIELDS))
+        for row in reader:
+            yield row['type'], row['client'], row['tx'], row['amount']
+
+def streaming_rows(path: str):
+    with engine.open_input(path) as csvfile:
+        yield from engine.read_rows(csvfile)
+
+@benchmark
+def bench_main(path: str, rows: int):
+    """The whole CLI in a fresh interpreter, so its peak RSS is its own."""
+    for name, flags in (('main', []), ('main/fixed', ['--fixed'])):
+        start = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, engine.__file__, *flags, path],
+                                stdout=subprocess.DEVNULL)
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        # Reaped by wait4, so tell Popen rather than letting it wait again
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        if proc.returncode:
+            raise RuntimeError(f'{name} exited with {proc.returncode}')
+        record(name, rows / elapsed, 'rows/s')
+        record(f'{name}/peak_rss', usage.ru_maxrss / 1024, 'MiB')
+
+@benchmark
+def bench_startup(path: str, rows: int):
+    """Fixed costs of a short run on a 100-row file: the import time of
+    payment_engine from -X importtime, and the median wall clock of a bare
+    interpreter, a fresh CLI run (as a script, which is compiled every time,
+    and with -m, which uses cached bytecode) and the same run by a warm
+    engine_worker."""
+    runs = 20
+    def median(times):
+        return sorted(times)[len(times) // 2] * 1000
+    def wall(argv):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            subprocess.run(argv, stdout=subprocess.DEVNULL, check=True,
+                           cwd=os.path.dirname(os.path.abspath(engine.__file__)))
+            times.append(time.perf_counter() - start)
+        return median(times)
+    imports = []
+    for _ in range(runs):
+        trace = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import payment_engine'],
+                               capture_output=True, text=True, check=True,
+                               cwd=os.path.dirname(os.path.abspath(engine.__file__))).stderr
+        line = next(line for line in trace.splitlines() if line.endswith('| payment_engine'))
+        imports.append(int(line.split('|')[1]) / 1e6)
+    record('startup/import', median(imports), 'ms')
+    record('startup/python', wall([sys.executable, '-c', 'pass']), 'ms')
+    with tempfile.TemporaryDirectory() as tmp:
+        small = os.path.join(tmp, 'partner.csv')
+        with open(small, 'w') as out:
+            out.write('type,client,tx,amount\n')
+            out.writelines(f'deposit,{tx % 10},{tx},1.5\n' for tx in range(1, 101))
+        record('startup/cli', wall([sys.executable, engine.__file__, '--fixed', small]), 'ms')
+        record('startup/cli_module', wall([sys.executable, '-m', 'payment_engine', '--fixed',
+                                           small]), 'ms')
+        sock = os.path.join(tmp, 'worker.sock')
+        worker = subprocess.Popen([sys.executable, engine_worker.__file__, sock])
+        try:
+            while not os.path.exists(sock):
+                time.sleep(0.01)
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                engine_worker.request(sock, [small, '--fixed'])
+                times.append(time.perf_counter() - start)
+            record('startup/worker', median(times), 'ms')
+        finally:
+            worker.terminate()
+            worker.wait()
+
+@benchmark
+def bench_parse(path: str, rows: int):
+    for name, reader in (('dictreader', dictreader_rows), ('read_rows', streaming_rows)):
+        start = time.perf_counter()
+        for _type, client, tx, amount in reader(path):
+            int(client), int(tx)
+        elapsed = time.perf_counter() - start
+        record(f'parse/{name}', rows / elapsed, 'rows/s')
+
+@benchmark
+def bench_apply(path: str, rows: int):
+    parsed = list(streaming_rows(path))
+    for name, tx_class in (('process_row', engine.Transaction),
+                           ('process_row/fixed', engine.FixedTransaction)):
+        engine.accounts = {}
+        engine.transactions = engine.TransactionStore(fixed=tx_class is engine.FixedTransaction)
+        start = time.perf_counter()
+        for _type, client, tx, amount in parsed:
+            engine.process_row(_type, int(client), int(tx), amount, tx_class)
+        elapsed = time.perf_counter() - start
+        record(f'apply/{name}', rows / elapsed, 'rows/s')
+    for name, fixed, metrics in (('Engine', False, None), ('Engine/fixed', True, None),
+                                 ('Engine/fixed+metrics', True, engine.Metrics())):
+        ledger = engine.Engine(fixed)
+        ledger.metrics = metrics
+        start = time.perf_counter()
+        ledger.apply_batch(parsed)
+        elapsed = time.perf_counter() - start
+        record(f'apply/{name}', rows / elapsed, 'rows/s')
+
+@benchmark
+def bench_numpy(path: str, rows: int):
+    """The vectorized apply path, when numpy is installed."""
+    try:
+        from engine_numpy import NumpyEngine
+    except ImportError:
+        print('numpy: skipped, numpy is not installed')
+        return
+    parsed = list(streaming_rows(path))
+    ledger = NumpyEngine()
+    start = time.perf_counter()
+    ledger.apply_batch(parsed)
+    record('apply/NumpyEngine', rows / (time.perf_counter() - start), 'rows/s')
+
+@benchmark
+def bench_pipeline(path: str, rows: int):
+    """Reading and parsing overlapped with applying, with each stage's
+    busy and waiting time."""
+    for name, process in (('thread', False), ('process', True)):
+        ledger = engine.Engine(fixed=True)
+        start = time.perf_counter()
+        with engine.open_input(path) as csvfile:
+            times = engine.run_pipelined(engine.read_rows(csvfile), ledger, process)
+        record(f'pipeline/{name}', rows / (time.perf_counter() - start), 'rows/s')
+        for stage, seconds in times.items():
+            record(f'pipeline/{name}/{stage}', seconds, 's')
+
+@benchmark
+def bench_kernel(path: str, rows: int):
+    """KernelEngine against Engine/fixed, from string rows and from typed
+    chunks; engine_kernel is compiled only if it has been built."""
+    parsed = list(streaming_rows(path))
+    chunk = engine.parse_chunk(parsed, fixed=True)
+    kind = 'compiled' if engine_kernel.COMPILED else 'python'
+    for name, make in (('Engine/fixed', lambda: engine.Engine(fixed=True)),
+                       (f'KernelEngine/{kind}', engine.KernelEngine)):
+        ledger = make()
+        start = time.perf_counter()
+        ledger.apply_batch(parsed)
+        record(f'kernel/{name}', rows / (time.perf_counter() - start), 'rows/s')
+        ledger = make()
+        start = time.perf_counter()
+        ledger.apply_chunk(chunk)
+        record(f'kernel/{name}/chunk', rows / (time.perf_counter() - start), 'rows/s')
+
+@benchmark
+def bench_dispatch(path: str, rows: int):
+    """Per-row cost of choosing a handler: the old TransactionType.X.value
+    comparison chain against the Engine's type-keyed effects table."""
+    types = [t.value for t in engine.TransactionType] * (rows // 5)
+    noop = lambda: None
+    def chain(_type):
+        if _type == engine.TransactionType.DEPOSIT.value:
+            noop()
+        elif _type == engine.TransactionType.WITHDRAWAL.value:
+            noop()
+        elif _type == engine.TransactionType.DISPUTE.value:
+            noop()
+        elif _type == engine.TransactionType.RESOLVE.value:
+            noop()
+        elif _type == engine.TransactionType.CHARGEBACK.value:
+            noop()
+    table = dict.fromkeys(engine.TYPES, noop)
+    def keyed(_type):
+        effect = table.get(_type)
+        if effect is not None:
+            effect()
+    for name, dispatch in (('if-chain', chain), ('table', keyed)):
+        start = time.perf_counter()
+        for _type in types:
+            dispatch(_type)
+        elapsed = time.perf_counter() - start
+        record(f'dispatch/{name}', elapsed / len(types) * 1e9, 'ns/row')
+
+@benchmark
+def bench_output(path: str, rows: int):
+    """Report writing for one account per row: print() per account against
+    write_report() in each format."""
+    accts = [engine.FixedAccount(client_id) for client_id in range(rows)]
+    with open(os.devnull, 'w') as devnull:
+        start = time.perf_counter()
+        print('client,available,held,total,locked', file=devnull)
+        for acct in accts:
+            print(acct, file=devnull)
+        record('output/print', rows / (time.perf_counter() - start), 'accounts/s')
+    for fmt in sorted(engine.REPORT_FORMATS):
+        with open(os.devnull, 'wb', buffering=1 << 20) as devnull:
+            start = time.perf_counter()
+            engine.write_report(accts, devnull, fmt)
+            record(f'output/{fmt}', rows / (time.perf_counter() - start), 'accounts/s')
+
+@benchmark
+def bench_snapshot(path: str, rows: int):
+    parsed = list(streaming_rows(path))
+    snap = f'{path}.snap'
+    ledger = engine.Engine(fixed=True)
+    start = time.perf_counter()
+    ledger.apply_batch(parsed)
+    replay = time.perf_counter() - start
+    start = time.perf_counter()
+    engine.write_snapshot(ledger, snap)
+    save = time.perf_counter() - start
+    start = time.perf_counter()
+    engine.read_snapshot(snap)
+    load = time.perf_counter() - start
+    record('snapshot/replay', replay, 's')
+    record('snapshot/save', save, 's')
+    record('snapshot/load', load, 's')
+    record('snapshot/size', os.path.getsize(snap) / rows, 'bytes/row')
+
+@benchmark
+def bench_wal(path: str, rows: int):
+    """Durable apply throughput at several group commit sizes. Runs are
+    capped at 1000 fsyncs, so small sizes see fewer rows."""
+    parsed = list(streaming_rows(path))
+    for sync_every, fsync in ((1, True), (16, True), (256, True), (4096, True), (4096, False)):
+        count = min(rows, 1000 * sync_every)
+        with tempfile.TemporaryDirectory() as wal:
+            with engine_wal.DurableEngine(wal, True, sync_every, compact_every=0,
+                                          fsync=fsync) as ledger:
+                start = time.perf_counter()
+                ledger.apply_batch(parsed[:count])
+                elapsed = time.perf_counter() - start
+        name = f'wal/sync_every={sync_every}' if fsync else 'wal/no_fsync'
+        record(name, count / elapsed, 'rows/s')
+    with tempfile.TemporaryDirectory() as wal:
+        with engine_wal.DurableEngine(wal, True, compact_every=0, fsync=False) as ledger:
+            ledger.apply_batch(parsed)
+        start = time.perf_counter()
+        engine_wal.DurableEngine(wal, True).close()
+        record('wal/recover', rows / (time.perf_counter() - start), 'rows/s')
+        with engine_wal.DurableEngine(wal, True) as ledger:
+            start = time.perf_counter()
+            ledger.checkpoint()
+            record('wal/checkpoint', time.perf_counter() - start, 's')
+
+@benchmark
+def bench_spill(path: str, rows: int):
+    """SpillStore at scale: insert rows deposits, then dispute lookups of
+    which 80% hit the most recent cache-size transactions. For a history
+    larger than RAM: python3 bench_engine.py 1000000000 --only spill"""
+    cache_size = max(1, min(rows // 10, 1_000_000))
+    lookups = min(rows, 100_000)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = engine_store.SpillStore(os.path.join(tmp, 'spill.db'), True, cache_size)
+        start = time.perf_counter()
+        for tx_id in range(rows):
+            store.add(tx_id, 'deposit', tx_id % 1000, tx_id % 100000)
+        record('spill/insert', rows / (time.perf_counter() - start), 'rows/s')
+        rng = random.Random(0)
+        disputed = [rng.randrange(max(0, rows - cache_size), rows) if rng.random() < 0.8
+                    else rng.randrange(rows) for _ in range(lookups)]
+        start = time.perf_counter()
+        for tx_id in disputed:
+            store.get(tx_id)
+        record('spill/lookup', lookups / (time.perf_counter() - start), 'lookups/s')
+        record('spill/hit_rate', store.stats()['hit_rate'], 'ratio')
+        record('spill/disk', os.path.getsize(store.path) / rows, 'bytes/tx')
+        store.close()
+
+@benchmark
+def bench_files(path: str, rows: int):
+    """The workload split into 24 hourly files: applied one after another,
+    against run_files() parsing them in a process pool."""
+    parsed = list(streaming_rows(path))
+    with tempfile.TemporaryDirectory() as tmp:
+        per_file = -(-len(parsed) // 24)
+        paths = []
+        for hour in range(24):
+            paths.append(os.path.join(tmp, f'{hour:02d}.csv'))
+            with open(paths[-1], 'w') as out:
+                gen_transactions.write_csv(out, parsed[hour * per_file:(hour + 1) * per_file])
+        ledger = engine.Engine(fixed=True)
+        start = time.perf_counter()
+        for part in paths:
+            ledger.apply_batch(streaming_rows(part))
+        record('files/sequential', rows / (time.perf_counter() - start), 'rows/s')
+        for jobs in sorted({2, os.cpu_count() or 2}):
+            start = time.perf_counter()
+            engine.run_files(paths, engine.Engine(fixed=True), jobs)
+            record(f'files/pool/{jobs}', rows / (time.perf_counter() - start), 'rows/s')
+
+@benchmark
+def bench_view(path: str, rows: int):
+    """Apply throughput through a LedgerView, alone and with a thread reading
+    single balances as fast as it can, and that thread's read latency."""
+    parsed = list(streaming_rows(path))
+    ledger = engine.Engine(fixed=True)
+    start = time.perf_counter()
+    ledger.apply_batch(parsed)
+    record('view/none', rows / (time.perf_counter() - start), 'rows/s')
+    view = engine_view.LedgerView(engine.Engine(fixed=True))
+    start = time.perf_counter()
+    view.apply_batch(parsed)
+    record('view/apply', rows / (time.perf_counter() - start), 'rows/s')
+    view = engine_view.LedgerView(engine.Engine(fixed=True))
+    clients = [int(row[1]) for row in parsed[:1000]]
+    done, latencies = threading.Event(), []
+    def read():
+        while not done.is_set():
+            for client_id in clients:
+                begin = time.perf_counter()
+                view.balance(client_id)
+                latencies.append(time.perf_counter() - begin)
+    reader = threading.Thread(target=read)
+    reader.start()
+    start = time.perf_counter()
+    view.apply_batch(parsed)
+    elapsed = time.perf_counter() - start
+    done.set()
+    reader.join()
+    latencies.sort()
+    record('view/apply_while_reading', rows / elapsed, 'rows/s')
+    record('view/reads', len(latencies) / elapsed, 'reads/s')
+    record('view/read_p99', latencies[int(len(latencies) * 0.99)] * 1e6, 'us')
+
+@benchmark
+def bench_workers(path: str, rows: int):
+    for workers in sorted({2, os.cpu_count() or 2}):
+        start = time.perf_counter()
+        engine.run_sharded(streaming_rows(path), workers, fixed=True)
+        elapsed = time.perf_counter() - start
+        record(f'sharded/{workers}', rows / elapsed, 'rows/s')
+
+class DictTransaction():
+    """Stand-in for the pre-__slots__ Transaction, for the memory baseline."""
+    def __init__(self, _type, client_id, tx_id, amount):
+        self._type = _type
+        self._client_id = client_id
+        self._tx_id = tx_id
+        self._amount = amount
+
+@benchmark
+def bench_memory(path: str, rows: int):
+    stores = (('dict+DictTransaction', dict, DictTransaction, Decimal),
+              ('dict+Transaction', dict, engine.Transaction, Decimal),
+              ('TransactionStore', engine.TransactionStore, engine.Transaction, Decimal),
+              ('TransactionStore(fixed)', lambda: engine.TransactionStore(fixed=True),
+               engine.FixedTransaction, engine.parse_amount))
+    rows = min(rows, 1_000_000)
+    for name, make_store, tx_class, parse in stores:
+        engine.accounts = {}
+        tracemalloc.start()
+        store = make_store()
+        for tx in range(rows):
+            store[tx] = tx_class('deposit', tx % 1000, tx, parse(f'{tx % 100000 / 100}'))
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del store
+        record(f'memory/{name}', used / rows, 'bytes/tx')
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def compare(old_path: str):
+    with open(old_path) as f:
+        old = json.load(f)
+    print(f'\ncompared with {old.get("commit")} ({old_path}):')
+    for name, result in results.items():
+        before = old['results'].get(name)
+        if before and before['value']:
+            print(f'{name}: {before["value"]:,.3f} -> {result["value"]:,.3f} {result["unit"]} '
+                  f'({result["value"] / before["value"]:.2f}x)')
+
+def main():
+    parser = ArgumentParser(description='Benchmark payment_engine.')
+    parser.add_argument('rows', nargs='?', type=int, default=1_000_000)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--zipf', type=float, default=1.1)
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('--json', metavar='PATH', help='save results as JSON')
+    parser.add_argument('--compare', metavar='PATH', help='compare with results saved by --json')
+    args = parser.parse_args()
+    names = args.only or list(BENCHMARKS)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'workload.csv')
+        if set(names) - STANDALONE:
+            with open(path, 'w') as out:
+                gen_transactions.write_csv(out, gen_transactions.generate(args.rows, args.clients,
+                                                                          args.zipf))
+        for name in names:
+            BENCHMARKS[name](path, args.rows)
+    record('peak_rss', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 'MiB')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'commit': git_commit(), 'python': platform.python_version(),
+                       'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                       'params': {'rows': args.rows, 'clients': args.clients, 'zipf': args.zipf},
+                       'results': results}, f, indent=2)
+    if args.compare:
+        compare(args.compare)
+
+if __name__ == '__main__':
+    main()
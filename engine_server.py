@@ -0,0 +1,239 @@
+"""Asyncio network ingestion server for payment_engine.
+
+Producers connect over TCP or a Unix socket and send newline-delimited rows,
+either CSV (deposit,1,1,1.0) or JSON ({"type": "deposit", "client": 1,
+"tx": 1, "amount": "1.0"}). Each row is answered with "ok" once it has been
+applied. A "balance,<client>" line (or {"query": "balance", "client": N})
+is answered with the account in the same format as Account.__str__.
+
+Run a server:  python3 engine_server.py serve --port 7878
+Load test it:  python3 engine_server.py loadtest --port 7878
+"""
+import asyncio, json, random, time
+from argparse import ArgumentParser
+from collections import deque
+from decimal import Decimal
+
+import payment_engine
+from engine_wal import DurableEngine
+
+QUERY = 'balance'
+# Marks a request that failed validation; never a real transaction type
+ERROR = ''
+U32_MAX = 0xFFFFFFFF
+# The largest amount a fixed-point store holds (an int64 of units), and the
+# same as a Decimal so that both modes accept the same amounts
+AMOUNT_MAX = 2**63 - 1
+DECIMAL_AMOUNT_MAX = Decimal('922337203685477.5807')
+
+
+def parse_line(line: str):
+    """Turn one request line into a (type, client, tx, amount) tuple of strings.
+
+    Queries come back as ('balance', client, '', '').
+    """
+    if line.startswith('{'):
+        request = json.loads(line)
+        if 'query' in request:
+            return (request['query'], str(request['client']), '', '')
+        return (request['type'], str(request['client']), str(request['tx']),
+                str(request.get('amount', '')))
+    fields = [field.strip() for field in line.split(',')] + ['', '', '']
+    return tuple(fields[:4])
+
+
+class LedgerServer():
+    """Feeds rows from many connections into one Engine.
+
+    Connection handlers validate rows and put them on a bounded queue; a
+    single applier task drains up to batch_size of them at a time into
+    Engine.apply_batch(). Rows are applied in arrival order, so each
+    producer's rows for a client keep their order. A full queue stops the
+    handlers reading, which pushes back on producers through TCP flow
+    control. Queries travel through the same queue so their answers reflect
+    every row the same connection sent before them.
+    """
+    def __init__(self, engine: payment_engine.Engine, batch_size: int=256, queue_size: int=4096):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.queue = asyncio.Queue(queue_size)
+
+    async def start(self, host: str=None, port: int=None, path: str=None):
+        applier = asyncio.ensure_future(self.apply_forever())
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        server.applier = applier
+        return server
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode().strip()
+                if not line:
+                    continue
+                try:
+                    row = self.validate(parse_line(line))
+                except (ValueError, KeyError, ArithmeticError) as err:
+                    # Answered by the applier to keep replies in request order
+                    row = (ERROR, str(err), '', '')
+                await self.queue.put((writer, row))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def validate(self, row):
+        _type, client, tx, amount = row
+        if not 0 <= int(client) <= U32_MAX:
+            raise ValueError(f'client {client} is not a u32')
+        if _type == QUERY:
+            return row
+        if _type not in payment_engine.TYPES:
+            raise ValueError(f'unknown transaction type {_type!r}')
+        if not 0 <= int(tx) <= U32_MAX:
+            raise ValueError(f'tx {tx} is not a u32')
+        if _type in payment_engine.RECORDED:
+            limit = AMOUNT_MAX if self.engine.fixed else DECIMAL_AMOUNT_MAX
+            if not 0 <= self.engine.parse_amount(amount) <= limit:
+                raise ValueError(f'invalid amount {amount!r}')
+        return row
+
+    async def apply_forever(self):
+        queue = self.queue
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+            self.apply(batch)
+
+    def apply(self, batch):
+        run = []
+        for writer, row in batch:
+            if row[0] not in (QUERY, ERROR):
+                run.append((writer, row))
+                continue
+            self.flush(run)
+            run = []
+            if row[0] == ERROR:
+                answer = f'error: {row[1]}'
+            else:
+                account = self.engine.accounts.get(int(row[1]))
+                answer = str(account) if account is not None else f'error: unknown client {row[1]}'
+            if not writer.is_closing():
+                writer.write(f'{answer}\n'.encode())
+        self.flush(run)
+
+    def flush(self, run):
+        """Apply a run of rows and acknowledge each one. A row that raises is
+        answered with an error and the rest of the run is applied after it."""
+        while run:
+            applied = 0
+            def rows():
+                nonlocal applied
+                for _, row in run:
+                    yield row
+                    # The engine asked for the next row, so this one is done
+                    applied += 1
+            failure = None
+            try:
+                self.engine.apply_batch(rows())
+            except Exception as err:
+                failure = err
+            for writer, _ in run[:applied]:
+                if not writer.is_closing():
+                    writer.write(b'ok\n')
+            if failure is None:
+                return
+            writer = run[applied][0]
+            if not writer.is_closing():
+                writer.write(f'error: {failure}\n'.encode())
+            run = run[applied + 1:]
+
+
+async def serve(args):
+    if args.wal:
+        # Rows are acknowledged only after the batch holding them is fsynced
+        engine = DurableEngine(args.wal, args.fixed, sync_every=args.batch_size)
+    elif args.load_snapshot:
+        engine = payment_engine.read_snapshot(args.load_snapshot)
+    else:
+        engine = payment_engine.Engine(args.fixed)
+    ledger = LedgerServer(engine, args.batch_size, args.queue_size)
+    server = await ledger.start(args.host, args.port, args.unix)
+    async with server:
+        await server.serve_forever()
+
+
+async def open_connection(args):
+    if args.unix:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+async def produce(args, producer: int, latencies: list):
+    """Send args.rows deposits/withdrawals with up to args.window in flight."""
+    reader, writer = await open_connection(args)
+    rng = random.Random(producer)
+    window = asyncio.Semaphore(args.window)
+    sent = deque()
+
+    async def read_acks():
+        for _ in range(args.rows):
+            line = await reader.readline()
+            if not line.startswith(b'ok'):
+                raise RuntimeError(f'server answered {line!r}')
+            latencies.append(time.perf_counter() - sent.popleft())
+            window.release()
+
+    acks = asyncio.ensure_future(read_acks())
+    for i in range(args.rows):
+        await window.acquire()
+        _type = 'deposit' if rng.random() < 0.7 else 'withdrawal'
+        tx = producer + i * args.producers + 1
+        sent.append(time.perf_counter())
+        writer.write(f'{_type},{rng.randint(1, args.clients)},{tx},{rng.randint(1, 100000) / 100}\n'.encode())
+        await writer.drain()
+    await acks
+    writer.close()
+
+async def loadtest(args):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(produce(args, producer, latencies) for producer in range(args.producers)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+    print(f'{len(latencies):,} rows in {elapsed:.2f}s: {len(latencies) / elapsed:,.0f} rows/s, '
+          f'p50 {p50 * 1e3:.2f}ms, p99 {p99 * 1e3:.2f}ms')
+
+
+def main():
+    parser = ArgumentParser(description='Serve a payment engine over a socket, or load test one.')
+    parser.add_argument('mode', choices=('serve', 'loadtest'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7878)
+    parser.add_argument('--unix', metavar='PATH', help='use a Unix socket instead of TCP')
+    parser.add_argument('--fixed', action='store_true', help='fixed-point amounts (serve)')
+    parser.add_argument('--load-snapshot', metavar='PATH', help='initial engine state (serve)')
+    parser.add_argument('--wal', metavar='DIR', help='log applied rows to DIR and recover from it (serve)')
+    parser.add_argument('--batch-size', type=int, default=256, help='rows applied per batch (serve)')
+    parser.add_argument('--queue-size', type=int, default=4096,
+                        help='rows queued before producers are pushed back (serve)')
+    parser.add_argument('--producers', type=int, default=8, help='concurrent connections (loadtest)')
+    parser.add_argument('--rows', type=int, default=10000, help='rows per producer (loadtest)')
+    parser.add_argument('--window', type=int, default=64, help='unacknowledged rows per producer (loadtest)')
+    parser.add_argument('--clients', type=int, default=1000, help='distinct clients (loadtest)')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args) if args.mode == 'serve' else loadtest(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Disk-backed transaction store for payment_engine.
+
+SpillStore is a drop-in for TransactionStore when the transaction history
+does not fit in memory. The most recently used transactions stay in an LRU
+cache; the rest are spilled to a SQLite table keyed by tx id, and a dispute
+of a spilled transaction reads it back transparently. Membership, which
+every deposit and withdrawal checks, is answered by a TxIdSet bitset, so it
+never touches the disk.
+
+    engine = Engine(fixed=True, transactions=SpillStore('spill.db', fixed=True))
+"""
+import os, sqlite3, tempfile
+from collections import OrderedDict
+from decimal import Decimal
+
+from payment_engine import StoredTransaction, TransactionStore, TxIdSet
+
+CACHE_SIZE = 1_000_000
+# Evicted transactions are written to SQLite up to this many at a time
+SPILL_BATCH = 10_000
+
+
+class SpillStore():
+    """tx_id -> (client, amount, type) index with an in-memory LRU in front of SQLite.
+
+    path is the SQLite file, a scratch file created on open and removed on
+    close(); an existing file there is a FileExistsError unless overwrite
+    is true. Without a path a temporary file is used.
+    """
+    KINDS = TransactionStore.KINDS
+    STATE_SHIFT = TransactionStore.STATE_SHIFT
+
+    def __init__(self, path: str=None, fixed: bool=False, cache_size: int=CACHE_SIZE,
+                 overwrite: bool=False):
+        self._fixed = fixed
+        self.cache_size = cache_size
+        self._spill_batch = max(1, min(SPILL_BATCH, cache_size // 10))
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.db', prefix='spill-')
+            os.close(fd)
+        else:
+            if overwrite and os.path.isfile(path):
+                os.remove(path)
+            # O_EXCL, so that another file cannot be put there in the meantime
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600))
+        self.path = path
+        self._db = sqlite3.connect(path)
+        # The spilled rows can always be rebuilt from the input or the WAL,
+        # so there is nothing to gain from journaling them
+        self._db.execute('PRAGMA journal_mode=OFF')
+        self._db.execute('PRAGMA synchronous=OFF')
+        self._db.execute('CREATE TABLE tx (id INTEGER PRIMARY KEY, kind INTEGER, client INTEGER, '
+                         'amount)')
+        self._ids = TxIdSet()
+        # tx_id -> (kind, client, amount, spilled)
+        self._cache = OrderedDict()
+        self._len = 0
+        self.hits = 0
+        self.misses = 0
+        self.spilled = 0
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, tx_id: int):
+        return tx_id in self._ids
+
+    def __getitem__(self, tx_id: int):
+        stored = self.get(tx_id)
+        if stored is None:
+            raise KeyError(tx_id)
+        return stored
+
+    def get(self, tx_id: int, default=None):
+        entry = self._entry(tx_id)
+        if entry is None:
+            return default
+        return StoredTransaction(self.KINDS[entry[0] & 3], entry[1], entry[2])
+
+    # The state is read and set right after get(), so a cached entry is not
+    # counted as another hit
+
+    def state(self, tx_id: int) -> int:
+        entry = self._cache.get(tx_id) or self._entry(tx_id)
+        return 0 if entry is None else entry[0] >> self.STATE_SHIFT
+
+    def set_state(self, tx_id: int, state: int):
+        kind, client, amount, _ = self._cache.get(tx_id) or self._entry(tx_id)
+        # Changed, so it must be written again when evicted
+        self._cache[tx_id] = (kind & 3 | state << self.STATE_SHIFT, client, amount, False)
+
+    def _entry(self, tx_id: int):
+        """The (kind, client, amount, spilled) of a tx, read back into the
+        cache if it was spilled."""
+        if tx_id not in self._ids:
+            return None
+        entry = self._cache.get(tx_id)
+        if entry is not None:
+            self.hits += 1
+            self._cache.move_to_end(tx_id)
+        else:
+            self.misses += 1
+            kind, client, amount = self._db.execute(
+                'SELECT kind, client, amount FROM tx WHERE id = ?', (tx_id,)).fetchone()
+            if not self._fixed:
+                amount = Decimal(amount)
+            entry = (kind, client, amount, True)
+            self._cache_entry(tx_id, entry)
+        return entry
+
+    def __setitem__(self, tx_id: int, transx):
+        self.add(tx_id, transx.tx_type, transx.client_id, transx.amount)
+
+    def add(self, tx_id: int, tx_type: str, client_id: int, amount):
+        if not 0 <= tx_id <= 0xFFFFFFFF:
+            raise ValueError(f'tx id {tx_id} is not a u32')
+        if tx_id not in self._ids:
+            self._ids.add(tx_id)
+            self._len += 1
+        self._cache.pop(tx_id, None)
+        self._cache_entry(tx_id, (self.KINDS.index(tx_type), client_id, amount, False))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {'cached': len(self._cache), 'spilled': self.spilled, 'hits': self.hits,
+                'misses': self.misses, 'hit_rate': self.hits / lookups if lookups else None}
+
+    def close(self):
+        self._db.close()
+        os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _cache_entry(self, tx_id: int, entry):
+        cache = self._cache
+        cache[tx_id] = entry
+        if len(cache) > self.cache_size:
+            self._spill(len(cache) - self.cache_size + self._spill_batch)
+
+    def _spill(self, count: int):
+        """Evict the count least recently used transactions, writing out
+        those that are not on disk yet."""
+        cache = self._cache
+        rows = []
+        for _ in range(min(count, len(cache))):
+            tx_id, (kind, client, amount, spilled) = cache.popitem(last=False)
+            if not spilled:
+                rows.append((tx_id, kind, client, amount if self._fixed else str(amount)))
+        self._db.executemany('INSERT OR REPLACE INTO tx VALUES (?, ?, ?, ?)', rows)
+        self._db.commit()
+        self.spilled += len(rows)
@@ -0,0 +1,154 @@
+"""Point-in-time balance queries while payment_engine is applying rows.
+
+LedgerView applies rows to an Engine in batches. After each batch it
+publishes immutable balance records for the clients that batch touched,
+and it updates the aggregates (clients, locked accounts, total held) from
+the changes. Publishing is guarded seqlock-style by a version counter. It
+is odd while records are being replaced, and readers retry if it moved
+under them. So a reader always sees every record and aggregate from the
+same batch boundary. Readers never block the apply loop, and the apply
+loop never waits for readers.
+
+Queries work in-process (balances(), totals()) or over a Unix socket with
+serve_queries(). Send "balance,<client>[,<client>...]" for one line per
+client, or "totals" for one JSON line.
+"""
+import json, os, socketserver, stat, threading, time
+from itertools import islice
+
+from payment_engine import format_amount
+
+VIEW_BATCH = 4096
+
+
+class LedgerView():
+    """Applies rows to engine and publishes consistent balance records."""
+    def __init__(self, engine, batch_size: int=VIEW_BATCH):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.version = 0
+        # client_id -> (client_id, available, held, total, locked)
+        self._records = {}
+        self._clients = 0
+        self._locked = 0
+        self._total_held = 0
+        self.publish(engine.accounts)
+
+    def apply(self, row):
+        self.apply_batch((row,))
+
+    def apply_batch(self, rows):
+        rows = iter(rows)
+        batch = list(islice(rows, self.batch_size))
+        while batch:
+            self.engine.apply_batch(batch)
+            touched = []
+            for client in {row[1] for row in batch}:
+                try:
+                    touched.append(int(client))
+                except ValueError:
+                    # Such a row was ignored, or apply_batch() would have raised
+                    pass
+            self.publish(touched)
+            batch = list(islice(rows, self.batch_size))
+
+    def publish(self, client_ids):
+        """Replace the records of client_ids with their current balances."""
+        accounts, records = self.engine.accounts, self._records
+        self.version += 1
+        for client_id in client_ids:
+            account = accounts.get(client_id)
+            if account is None:
+                continue
+            old = records.get(client_id)
+            record = (client_id, account.available, account.held, account.total, account.locked)
+            if old is None:
+                self._clients += 1
+                self._locked += record[4]
+            else:
+                self._locked += record[4] - old[4]
+            records[client_id] = record
+        self._total_held = self.engine.total_held
+        self.version += 1
+
+    def balances(self, client_ids) -> tuple:
+        """(version, records) as of one batch boundary; a record is None for
+        a client without an account."""
+        while True:
+            version = self.version
+            if not version & 1:
+                records = [self._records.get(client_id) for client_id in client_ids]
+                if self.version == version:
+                    return version, records
+            time.sleep(0)
+
+    def balance(self, client_id: int):
+        return self.balances((client_id,))[1][0]
+
+    def totals(self) -> dict:
+        while True:
+            version = self.version
+            if not version & 1:
+                totals = {'version': version, 'clients': self._clients, 'locked': self._locked,
+                          'total_held': self._total_held}
+                if self.version == version:
+                    return totals
+            time.sleep(0)
+
+    def amount(self, value) -> str:
+        return format_amount(value) if self.engine.fixed else str(value)
+
+    def format(self, record) -> str:
+        """A record in the report's text format."""
+        client_id, available, held, total, locked = record
+        amount = self.amount
+        return f'{client_id}, {amount(available)}, {amount(held)}, {amount(total)}, {locked}'
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        view = self.server.view
+        for line in self.rfile:
+            fields = [field.strip() for field in line.decode().split(',')]
+            if fields[0] == 'totals':
+                totals = view.totals()
+                totals['total_held'] = view.amount(totals['total_held'])
+                answer = json.dumps(totals)
+            elif fields[0] == 'balance' and len(fields) > 1:
+                try:
+                    client_ids = [int(field) for field in fields[1:]]
+                except ValueError:
+                    answer = f'error: bad client id in {line.decode().strip()}'
+                else:
+                    _, records = view.balances(client_ids)
+                    answer = '\n'.join(view.format(record) if record is not None
+                                       else f'error: unknown client {client_id}'
+                                       for client_id, record in zip(client_ids, records))
+            else:
+                answer = f'error: unknown query {line.decode().strip()}'
+            self.wfile.write(f'{answer}\n'.encode())
+
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def remove_socket(path: str):
+    """Remove a stale Unix socket at path, refusing to remove anything else."""
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f'{path} exists and is not a socket')
+    os.remove(path)
+
+def serve_queries(view: LedgerView, path: str) -> QueryServer:
+    """Answer queries on a Unix socket at path from a background thread.
+    A socket left at path by an earlier run is replaced; anything else
+    there is a FileExistsError."""
+    remove_socket(path)
+    server = QueryServer(path, QueryHandler)
+    server.view = view
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
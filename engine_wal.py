@@ -0,0 +1,195 @@
+"""Write-ahead log and crash recovery for payment_engine.
+
+A DurableEngine keeps its state in a directory of generations: snapshot-N
+is the engine state at the start of wal-N, and wal-N holds every row
+applied since, in frames of one group commit each. Rows are applied, then
+their frame is written and fsynced before apply_batch() returns, so one
+fsync covers sync_every rows. checkpoint() starts a new generation and
+folds the old one into a snapshot; recovery loads the newest snapshot and
+replays the logs after it, dropping a frame torn by a crash mid-write.
+
+Logs are replayed through Engine.apply_batch(), so replay gives exactly the
+state the rows gave the first time.
+"""
+import os, struct, zlib
+from itertools import islice
+
+from payment_engine import Engine, read_snapshot, write_snapshot
+
+WAL_MAGIC = b'PAYWAL1\n'
+# magic, fixed, rows applied before this log
+WAL_HEADER = struct.Struct('<8sBQ')
+# payload length, crc32 of the payload
+FRAME_HEADER = struct.Struct('<II')
+SYNC_EVERY = 1024
+COMPACT_EVERY = 1_000_000
+
+
+def _taken(rows, batch: list):
+    """Yield rows, appending each to batch as it is taken."""
+    for row in rows:
+        batch.append(row)
+        yield row
+
+
+class DurableEngine():
+    """An Engine whose applied rows survive a crash.
+
+    rows counts every row applied through this directory, so a run over the
+    same input can skip the rows it already applied.
+    """
+    def __init__(self, directory: str, fixed: bool=False, sync_every: int=SYNC_EVERY,
+                 compact_every: int=COMPACT_EVERY, fsync: bool=True):
+        self.directory = directory
+        self.sync_every = sync_every
+        self.compact_every = compact_every
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self._recover(fixed)
+
+    @property
+    def accounts(self):
+        return self.engine.accounts
+
+    @property
+    def fixed(self):
+        return self.engine.fixed
+
+    @property
+    def parse_amount(self):
+        return self.engine.parse_amount
+
+    def apply(self, row):
+        self.apply_batch((row,))
+
+    def apply_batch(self, rows):
+        """Apply and log rows. Rows are handed to the engine one at a time, so
+        if one raises, the rows applied before it are still logged. That
+        needs an engine that takes no row before it has applied the last,
+        which NumpyEngine's chunks are not."""
+        rows = iter(rows)
+        while True:
+            batch = []
+            try:
+                self.engine.apply_batch(_taken(islice(rows, self.sync_every), batch))
+            except BaseException:
+                # The last row taken is the one that failed
+                if len(batch) > 1:
+                    self._commit(batch[:-1])
+                raise
+            if not batch:
+                return
+            self._commit(batch)
+            if self.compact_every and self._logged >= self.compact_every:
+                self.checkpoint()
+
+    def checkpoint(self):
+        """Fold the current log into a snapshot and start a new one."""
+        self._log.close()
+        generation = self.generation + 1
+        self._open_log(generation)
+        write_snapshot(self.engine, self._path('snapshot', generation))
+        self._sync_directory()
+        for name in os.listdir(self.directory):
+            kind, _, number = name.partition('-')
+            if kind in ('snapshot', 'wal') and number.isdigit() and int(number) < generation:
+                os.remove(os.path.join(self.directory, name))
+
+    def close(self):
+        self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _commit(self, batch):
+        payload = ''.join([f'{_type},{client},{tx},{amount}\n'
+                           for _type, client, tx, amount in batch]).encode()
+        self._log.write(FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        if self.fsync:
+            os.fsync(self._log.fileno())
+        self.rows += len(batch)
+        self._logged += len(batch)
+
+    def _path(self, kind: str, generation: int):
+        return os.path.join(self.directory, f'{kind}-{generation:08d}')
+
+    def _generations(self, kind: str):
+        return sorted(int(name[len(kind) + 1:]) for name in os.listdir(self.directory)
+                      if name.startswith(f'{kind}-') and name[len(kind) + 1:].isdigit())
+
+    def _recover(self, fixed: bool):
+        snapshots = self._generations('snapshot')
+        if snapshots:
+            self.generation = snapshots[-1]
+            self.engine = read_snapshot(self._path('snapshot', self.generation))
+            if self.engine.fixed != fixed:
+                raise ValueError(f'{self.directory} was not saved with fixed={fixed}')
+        else:
+            self.generation = 1
+            self.engine = Engine(fixed)
+        self.rows = 0
+        logs = [generation for generation in self._generations('wal')
+                if generation >= self.generation]
+        for generation in logs:
+            self.rows = self._replay(generation, fixed, last=generation == logs[-1])
+        if logs:
+            self.generation = logs[-1]
+        path = self._path('wal', self.generation)
+        if os.path.exists(path):
+            self._log = open(path, 'ab', buffering=0)
+            self._logged = 0
+        else:
+            self._open_log(self.generation)
+
+    def _replay(self, generation: int, fixed: bool, last: bool):
+        """Apply one log's frames; returns the row count after them."""
+        path = self._path('wal', generation)
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) < WAL_HEADER.size and last:
+            # Torn while being created, so it never held a row
+            os.remove(path)
+            return self.rows
+        magic, log_fixed, rows = WAL_HEADER.unpack_from(data.ljust(WAL_HEADER.size))
+        if magic != WAL_MAGIC or log_fixed != fixed:
+            raise ValueError(f'{path} is not a write-ahead log for fixed={fixed}')
+        pos = WAL_HEADER.size
+        while pos < len(data):
+            end = pos + FRAME_HEADER.size
+            if end <= len(data):
+                size, crc = FRAME_HEADER.unpack_from(data, pos)
+                payload = data[end:end + size]
+                if len(payload) == size and zlib.crc32(payload) == crc:
+                    # Only '\n' ends a row; splitlines() would also split
+                    # on characters a row of unknown type may hold
+                    lines = payload.decode().split('\n')[:-1]
+                    self.engine.apply_batch([line.split(',') for line in lines])
+                    rows += len(lines)
+                    pos = end + size
+                    continue
+            if not last:
+                raise ValueError(f'{path} is corrupt at byte {pos}')
+            # A crash mid-write leaves a partial frame at the end; its rows
+            # were never acknowledged, so drop it
+            with open(path, 'r+b') as f:
+                f.truncate(pos)
+            break
+        return rows
+
+    def _open_log(self, generation: int):
+        self.generation = generation
+        self._log = open(self._path('wal', generation), 'wb', buffering=0)
+        self._log.write(WAL_HEADER.pack(WAL_MAGIC, self.engine.fixed, self.rows))
+        os.fsync(self._log.fileno())
+        self._sync_directory()
+        self._logged = 0
+
+    def _sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,98 @@
+"""Warm worker: a long-lived payment_engine process for many short runs.
+
+Every payment_engine.py run pays for starting the interpreter and importing
+the engine before it reads a row, which dominates the time on small files.
+The worker pays that once. Each connection to its Unix socket sends one line
+with the arguments of a payment_engine.py run, for example:
+
+    echo 'partner-0042.csv --fixed --format csv' | nc -U /tmp/engine.sock
+
+and gets back "ok", the report and, with --metrics, the metrics, or one
+"error: <message>" line. Runs are handled one at a time, each with a fresh
+Engine. Relative paths are resolved from the worker's working directory.
+Clients can only pass the options in OPTIONS, which read files but never
+write them; options such as --output, --spill or --query-socket would let
+anyone who can reach the socket replace files the worker can write.
+
+Run it: python3 engine_worker.py /tmp/engine.sock
+"""
+import io, shlex, signal, socket, socketserver
+from argparse import ArgumentParser
+from contextlib import redirect_stderr
+
+import payment_engine
+# Imported here so that no run has to; main() only imports them when asked
+import argparse, gzip, glob, heapq, json, mmap
+import engine_kernel, engine_store, engine_view, engine_wal
+from engine_view import remove_socket
+
+
+# The payment_engine options a client may pass
+OPTIONS = {'--jobs', '--order-by', '--fixed', '--numpy', '--kernel', '--workers', '--pipeline',
+           '--load-snapshot', '--format', '--sort', '--metrics'}
+
+
+def run(args: list) -> bytes:
+    """The worker's answer to one run of payment_engine with args."""
+    if '-' in args:
+        return b'error: stdin input is not supported by the worker\n'
+    for arg in args:
+        if arg.startswith('-') and arg.split('=', 1)[0] not in OPTIONS:
+            return f'error: {arg.split("=", 1)[0]} is not supported by the worker\n'.encode()
+    report, errors, metrics = io.BytesIO(), io.StringIO(), io.StringIO()
+    # main() sets a SIGUSR1 handler for the run's metrics; it must not outlive the run
+    handler = signal.getsignal(signal.SIGUSR1)
+    try:
+        with redirect_stderr(errors):
+            payment_engine.main(args, report, metrics)
+    except SystemExit as e:
+        if e.code:
+            message = e.code if isinstance(e.code, str) else \
+                (errors.getvalue().strip().splitlines() or [f'exit status {e.code}'])[-1]
+            return f'error: {message}\n'.encode()
+    except Exception as e:
+        return f'error: {type(e).__name__}: {e}\n'.encode()
+    finally:
+        if signal.getsignal(signal.SIGUSR1) is not handler:
+            signal.signal(signal.SIGUSR1, handler)
+    return b'ok\n' + report.getvalue() + metrics.getvalue().encode()
+
+
+class WorkerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            args = shlex.split(self.rfile.readline().decode())
+        except ValueError as e:
+            self.wfile.write(f'error: {e}\n'.encode())
+        else:
+            self.wfile.write(run(args))
+
+
+def serve(path: str):
+    remove_socket(path)
+    with socketserver.UnixStreamServer(path, WorkerHandler) as server:
+        server.serve_forever()
+
+
+def request(path: str, args: list) -> bytes:
+    """Have the worker at path run payment_engine with args; returns its
+    answer, "ok\\n" and the report or an error line."""
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        sock.sendall(f'{shlex.join(args)}\n'.encode())
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as answer:
+            return answer.read()
+
+
+def main():
+    parser = ArgumentParser(description='Serve payment_engine runs from a warm process.')
+    parser.add_argument('path', help='Unix socket to listen on')
+    args = parser.parse_args()
+    try:
+        serve(args.path)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
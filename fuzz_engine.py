@@ -0,0 +1,362 @@
+"""Differential fuzzing of payment_engine's backends against a reference model.
+
+Random streams of rows are applied by reference(), a small model of the
+engine's rules written separately from payment_engine, and then by every
+backend, including the legacy process_row() path. A backend whose account
+lines differ from the model's, in content or in order, is a mismatch. Its
+stream is shrunk to a minimal reproducing CSV and written to --out. The
+streams are built to hit the edge cases: duplicate tx ids, disputes of
+another client's or an unknown tx, repeated disputes, resolves and
+chargebacks of undisputed deposits, disputed withdrawals, overdraws, rows
+for locked accounts, unknown and miscased row types, zero and negative
+amounts, and tx ids spread across store pages. Every backend's throughput
+is reported as a side result.
+
+The model shares two things with the engine: Decimal arithmetic, in the
+context payment_engine sets up, and the report format. A backend can
+still agree with the model on a wrong result if both misread the rules
+the same way, or if Decimal itself is wrong.
+
+Run: python3 fuzz_engine.py [--streams N] [--rows N] [--backends engine kernel ...] [--out DIR]
+"""
+import os, random, sys, tempfile, time
+from argparse import ArgumentParser
+from decimal import Context, Decimal
+
+import payment_engine as engine
+import gen_transactions
+from engine_kernel import COMPILED
+from engine_store import SpillStore
+from engine_view import LedgerView
+from engine_wal import DurableEngine
+
+BACKENDS = {}
+# Backends that only keep fixed-point amounts
+FIXED_ONLY = set()
+
+def backend(name: str, fixed_only: bool=False):
+    def register(func):
+        BACKENDS[name] = func
+        if fixed_only:
+            FIXED_ONLY.add(name)
+        return func
+    return register
+
+# Row types that the engine does not know, and must ignore
+UNKNOWN_TYPES = ('refund', 'transfer', 'Deposit', 'WITHDRAWAL', 'Dispute', 'chargeBack')
+
+def report(accounts) -> list:
+    """Account lines in the order the backend emits them."""
+    return [str(account) for account in accounts]
+
+# payment_engine lowers the default context's precision to 4 digits
+_EXACT = Context(prec=64)
+
+def _fixed_units(text: str) -> int:
+    return int(Decimal(text).scaleb(4, _EXACT).to_integral_value(context=_EXACT))
+
+def _fixed_text(units: int) -> str:
+    whole, frac = divmod(abs(units), 10000)
+    return f'{"-" if units < 0 else ""}{whole}.{frac:04d}'
+
+def reference(rows, fixed: bool) -> list:
+    """Account lines after applying rows, by the engine's rules:
+
+    - Rows of an unknown type are ignored.
+    - A deposit or withdrawal whose tx id was seen before is ignored;
+      otherwise it is recorded, whatever happens to it next.
+    - A dispute, resolve or chargeback of an unrecorded tx id is ignored.
+    - Any other row opens its client's account, and accounts are reported
+      in the order they were opened.
+    - Nothing changes a locked account.
+    - A withdrawal of more than is available fails.
+    - A dispute, resolve or chargeback only applies to a deposit of the
+      same client. A deposit can be disputed when it is undisputed or
+      resolved. It can be resolved or charged back only while disputed.
+    - A chargeback locks the account.
+    """
+    parse, zero = (_fixed_units, 0) if fixed else (Decimal, Decimal(0))
+    # client -> [available, held, total, locked]
+    accounts = {}
+    # tx -> [client, amount, is a deposit, dispute state]
+    recorded = {}
+    for _type, client, tx, amount in rows:
+        client, tx = int(client), int(tx)
+        if _type in ('deposit', 'withdrawal'):
+            if tx in recorded:
+                continue
+            amount = parse(amount)
+            recorded[tx] = [client, amount, _type == 'deposit', 'undisputed']
+        elif _type not in ('dispute', 'resolve', 'chargeback') or tx not in recorded:
+            continue
+        account = accounts.setdefault(client, [zero, zero, zero, False])
+        if account[3]:
+            continue
+        if _type == 'deposit':
+            account[0] += amount
+            account[2] += amount
+        elif _type == 'withdrawal':
+            if amount <= account[0]:
+                account[0] -= amount
+                account[2] -= amount
+        else:
+            entry = recorded[tx]
+            owner, amount, deposit, state = entry
+            if owner != client or not deposit:
+                continue
+            if _type == 'dispute' and state in ('undisputed', 'resolved'):
+                entry[3] = 'disputed'
+                account[0] -= amount
+                account[1] += amount
+            elif _type == 'resolve' and state == 'disputed':
+                entry[3] = 'resolved'
+                account[0] += amount
+                account[1] -= amount
+            elif _type == 'chargeback' and state == 'disputed':
+                entry[3] = 'chargedback'
+                account[1] -= amount
+                account[2] -= amount
+                account[3] = True
+    text = _fixed_text if fixed else str
+    return [f'{client}, {text(available)}, {text(held)}, {text(total)}, {locked}'
+            for client, (available, held, total, locked) in accounts.items()]
+
+@backend('process_row')
+def run_process_row(rows, fixed):
+    """The legacy API: process_row() on the module-level accounts."""
+    engine.accounts = {}
+    engine.transactions = engine.TransactionStore(fixed=fixed)
+    tx_class = engine.FixedTransaction if fixed else engine.Transaction
+    for _type, client, tx, amount in rows:
+        engine.process_row(_type, int(client), int(tx), amount, tx_class)
+    return report(engine.accounts.values())
+
+@backend('engine')
+def run_engine(rows, fixed):
+    ledger = engine.Engine(fixed)
+    ledger.apply_batch(rows)
+    return report(ledger.accounts.values())
+
+@backend('chunk')
+def run_chunk(rows, fixed):
+    ledger = engine.Engine(fixed)
+    ledger.apply_chunk(engine.parse_chunk(rows, fixed))
+    return report(ledger.accounts.values())
+
+@backend('kernel', fixed_only=True)
+def run_kernel(rows, fixed):
+    ledger = engine.KernelEngine()
+    ledger.apply_batch(rows)
+    return report(ledger.accounts.values())
+
+try:
+    from engine_numpy import NumpyEngine
+except ImportError:
+    pass
+else:
+    @backend('numpy', fixed_only=True)
+    def run_numpy(rows, fixed):
+        ledger = NumpyEngine(chunk_size=256)
+        ledger.apply_batch(rows)
+        return report(ledger.accounts.values())
+
+@backend('sharded')
+def run_sharded(rows, fixed):
+    return report(engine.run_sharded(iter(rows), 3, fixed))
+
+@backend('pipeline')
+def run_pipeline(rows, fixed):
+    ledger = engine.Engine(fixed)
+    engine.run_pipelined(iter(rows), ledger, chunk_size=256)
+    return report(ledger.accounts.values())
+
+@backend('files')
+def run_files(rows, fixed):
+    with tempfile.TemporaryDirectory() as tmp:
+        per_file = -(-len(rows) // 3)
+        paths = []
+        for i in range(3):
+            paths.append(os.path.join(tmp, f'{i}.csv'))
+            with open(paths[-1], 'w') as out:
+                gen_transactions.write_csv(out, rows[i * per_file:(i + 1) * per_file], header=i == 0)
+        ledger = engine.Engine(fixed)
+        engine.run_files(paths, ledger, jobs=2)
+    return report(ledger.accounts.values())
+
+@backend('spill')
+def run_spill(rows, fixed):
+    store = SpillStore(fixed=fixed, cache_size=64)
+    try:
+        ledger = engine.Engine(fixed, transactions=store)
+        ledger.apply_batch(rows)
+        return report(ledger.accounts.values())
+    finally:
+        store.close()
+
+@backend('snapshot')
+def run_snapshot(rows, fixed):
+    """Half the rows, a snapshot round trip, then the rest."""
+    ledger = engine.Engine(fixed)
+    ledger.apply_batch(rows[:len(rows) // 2])
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'snapshot')
+        engine.write_snapshot(ledger, path)
+        ledger = engine.read_snapshot(path)
+        ledger.apply_batch(rows[len(rows) // 2:])
+        return report(ledger.accounts.values())
+
+@backend('wal')
+def run_wal(rows, fixed):
+    """The rows through a write-ahead log with frequent compaction, then
+    recovered from it."""
+    with tempfile.TemporaryDirectory() as tmp:
+        with DurableEngine(tmp, fixed, sync_every=64, compact_every=500, fsync=False) as ledger:
+            ledger.apply_batch(rows)
+        with DurableEngine(tmp, fixed, fsync=False) as ledger:
+            return report(ledger.accounts.values())
+
+@backend('view')
+def run_view(rows, fixed):
+    view = LedgerView(engine.Engine(fixed), batch_size=97)
+    view.apply_batch(rows)
+    _, records = view.balances(list(view.engine.accounts))
+    return [view.format(record) for record in records]
+
+
+def amount(rng: random.Random) -> str:
+    """An amount with up to four decimals, padded with zeros to four places
+    half of the time. A few are zero or negative."""
+    units = rng.choice((rng.randint(1, 100), rng.randint(1, 10**4), rng.randint(1, 10**6)))
+    whole, frac = divmod(units * 10 ** rng.randint(0, 4), engine.SCALE)
+    text = f'{whole}.{frac:04d}'
+    text = text if rng.random() < 0.5 else text.rstrip('0').rstrip('.')
+    roll = rng.random()
+    if roll < 0.01:
+        return rng.choice(('0', '0.0', '0.0000'))
+    return f'-{text}' if roll < 0.03 else text
+
+def generate(rows: int, seed: int, clients: int=32) -> list:
+    """A stream of rows biased towards the edge cases. Chargebacks are rare
+    enough that most of the stream happens before its clients are locked."""
+    rng = random.Random(seed)
+    recorded, disputed = [], []
+    tx = rng.choice((0, rng.randrange(2**31)))
+    stream = []
+    for _ in range(rows):
+        client = str(rng.randint(1, clients))
+        roll = rng.random()
+        if roll < 0.02:
+            # Unknown or miscased type, of a new or a recorded tx id
+            stream.append((rng.choice(UNKNOWN_TYPES), client,
+                           rng.choice(recorded)[1] if recorded and roll < 0.01 else str(tx + 1),
+                           rng.choice((amount(rng), ''))))
+        elif roll < 0.45 or not recorded:
+            # Gaps between ids, and rarely a skip to a new page of the
+            # transaction store (each one costs a whole page in memory)
+            tx += 65536 if rng.random() < 0.001 and tx < 3 << 30 else rng.choice((1, 1, 1, 2))
+            _type = 'deposit' if roll < 0.3 else 'withdrawal'
+            recorded.append((client, str(tx)))
+            stream.append((_type, client, str(tx), amount(rng)))
+        elif roll < 0.5:
+            # Duplicate tx id, possibly of another client
+            stream.append((rng.choice(('deposit', 'withdrawal')), client,
+                           rng.choice(recorded)[1], amount(rng)))
+        elif roll < 0.7:
+            d_client, d_tx = rng.choice(recorded[-50:] if roll < 0.65 else recorded)
+            disputed.append((d_client, d_tx))
+            stream.append(('dispute', d_client, d_tx, ''))
+        elif roll < 0.85:
+            d_client, d_tx = rng.choice(disputed or recorded)
+            stream.append(('resolve' if roll < 0.845 else 'chargeback', d_client, d_tx, ''))
+        elif roll < 0.9:
+            # Cross-client reference to an existing tx
+            stream.append((rng.choice(('dispute', 'dispute', 'resolve', 'chargeback')), client,
+                           rng.choice(recorded)[1], ''))
+        elif roll < 0.95:
+            # Repeated dispute, resolve or chargeback
+            stream.append(stream[-1] if stream[-1][0] not in engine.RECORDED else
+                          ('dispute', *stream[-1][1:3], ''))
+        else:
+            stream.append((rng.choice(('dispute', 'resolve', 'chargeback')), client,
+                           str(tx + rng.randint(1, 1000)), ''))
+    return stream
+
+def shrink(rows: list, fails) -> list:
+    """The shortest sublist of rows found for which fails() still holds,
+    removing chunks of rows, halving their size down to single rows."""
+    chunk = len(rows) // 2
+    while chunk >= 1:
+        i = 0
+        while i < len(rows):
+            candidate = rows[:i] + rows[i + chunk:]
+            if candidate and fails(candidate):
+                rows = candidate
+            else:
+                i += chunk
+        chunk //= 2
+    return rows
+
+def run(rows, name: str, fixed: bool):
+    """A backend's report, or the exception it raised as a string."""
+    try:
+        return BACKENDS[name](rows, fixed)
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+
+def fuzz(streams: int, rows: int, backends: list, seed: int=0, out: str=None, log=sys.stdout) -> tuple:
+    """Compare backends with the reference on streams random streams in both
+    amount modes. Returns (mismatches, throughput): a list of (backend,
+    fixed, seed, minimal rows) and rows/s per backend."""
+    mismatches, elapsed, applied = [], {}, {}
+    for fixed in (False, True):
+        mode = 'fixed' if fixed else 'decimal'
+        names = [name for name in backends if fixed or name not in FIXED_ONLY]
+        for stream_seed in range(seed, seed + streams):
+            stream = generate(rows, stream_seed)
+            start = time.perf_counter()
+            expected = reference(stream, fixed)
+            elapsed[f'reference/{mode}'] = elapsed.get(f'reference/{mode}', 0) + \
+                time.perf_counter() - start
+            applied[f'reference/{mode}'] = applied.get(f'reference/{mode}', 0) + rows
+            for name in names:
+                start = time.perf_counter()
+                got = run(stream, name, fixed)
+                key = f'{name}/{mode}'
+                elapsed[key] = elapsed.get(key, 0) + time.perf_counter() - start
+                applied[key] = applied.get(key, 0) + rows
+                if got == expected:
+                    continue
+                minimal = shrink(stream, lambda rows: run(rows, name, fixed) != reference(rows, fixed))
+                mismatches.append((name, fixed, stream_seed, minimal))
+                print(f'MISMATCH {key} seed {stream_seed}: {len(minimal)} rows', file=log)
+                print(f'  expected {reference(minimal, fixed)}', file=log)
+                print(f'  got      {run(minimal, name, fixed)}', file=log)
+                if out is not None:
+                    os.makedirs(out, exist_ok=True)
+                    path = os.path.join(out, f'mismatch-{name}-{mode}-{stream_seed}.csv')
+                    with open(path, 'w') as csvfile:
+                        gen_transactions.write_csv(csvfile, minimal)
+                    print(f'  written to {path}', file=log)
+    throughput = {key: applied[key] / elapsed[key] for key in elapsed}
+    return mismatches, throughput
+
+def main():
+    parser = ArgumentParser(description='Differential fuzzing of payment_engine backends.')
+    parser.add_argument('--streams', type=int, default=100, help='random streams per amount mode')
+    parser.add_argument('--rows', type=int, default=10000, help='rows per stream')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first stream')
+    parser.add_argument('--backends', nargs='+', choices=sorted(BACKENDS), default=sorted(BACKENDS),
+                        metavar='NAME', help=f'backends to compare (default: all of {", ".join(sorted(BACKENDS))})')
+    parser.add_argument('--out', default='.', metavar='DIR',
+                        help='where to write the minimal CSV of each mismatch (default: .)')
+    args = parser.parse_args()
+    print(f'engine_kernel is {"compiled" if COMPILED else "pure Python"}')
+    mismatches, throughput = fuzz(args.streams, args.rows, args.backends, args.seed, args.out)
+    for key, rate in sorted(throughput.items()):
+        print(f'{key}: {rate:,.0f} rows/s')
+    print(f'{len(mismatches)} mismatches in {args.streams} streams of {args.rows} rows '
+          f'per amount mode')
+    sys.exit(1 if mismatches else 0)
+
+if __name__ == '__main__':
+    main()
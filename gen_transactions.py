@@ -0,0 +1,101 @@
+"""Synthetic transaction CSVs for testing and benchmarking payment_engine.
+
+Clients are drawn from a Zipf distribution, so a few clients are very busy
+and most are quiet. Disputes pick a recent deposit of the same client, and
+resolves and chargebacks pick an open dispute, so the dispute rows actually
+exercise the engine instead of being ignored as unknown tx ids.
+
+Run: python3 gen_transactions.py <output.csv[.gz] | -> [--rows N] [--clients N] ...
+"""
+import gzip, random, sys
+from argparse import ArgumentParser
+from itertools import accumulate
+
+# How many recent deposits and open disputes to remember for later rows
+POOL_SIZE = 100_000
+
+def zipf_weights(clients: int, s: float):
+    """Cumulative weights for client ids 1..clients, P(k) proportional to 1/k**s."""
+    return list(accumulate(1 / k ** s for k in range(1, clients + 1)))
+
+def generate(rows: int, clients: int=1000, zipf: float=1.1, withdrawal: float=0.3,
+             dispute: float=0.01, resolve: float=0.005, chargeback: float=0.002, seed: int=0):
+    """Yield rows (type, client, tx, amount) as strings.
+
+    The ratios are fractions of all rows; whatever they leave over is
+    deposits. A resolve or chargeback with no open dispute to refer to, or a
+    dispute with no deposit, is written as a deposit instead.
+    """
+    rng = random.Random(seed)
+    client_ids = range(1, clients + 1)
+    cum_weights = zipf_weights(clients, zipf)
+    cuts = list(accumulate((withdrawal, dispute, resolve, chargeback)))
+    deposits, disputes = [], []
+    tx = 0
+    batch = 4096
+    for start in range(0, rows, batch):
+        picks = rng.choices(client_ids, cum_weights=cum_weights, k=min(batch, rows - start))
+        for client in picks:
+            roll = rng.random()
+            if roll < cuts[0]:
+                tx += 1
+                yield ('withdrawal', str(client), str(tx), f'{rng.randint(1, 50000) / 100}')
+                continue
+            if roll < cuts[1] and deposits:
+                d_client, d_tx = deposits[rng.randrange(len(deposits))]
+                if len(disputes) >= POOL_SIZE:
+                    disputes[rng.randrange(POOL_SIZE)] = (d_client, d_tx)
+                else:
+                    disputes.append((d_client, d_tx))
+                yield ('dispute', d_client, d_tx, '')
+                continue
+            if roll >= cuts[1] and roll < cuts[3] and disputes:
+                i = rng.randrange(len(disputes))
+                d_client, d_tx = disputes[i]
+                disputes[i] = disputes[-1]
+                disputes.pop()
+                yield ('resolve' if roll < cuts[2] else 'chargeback', d_client, d_tx, '')
+                continue
+            tx += 1
+            if len(deposits) >= POOL_SIZE:
+                deposits[rng.randrange(POOL_SIZE)] = (str(client), str(tx))
+            else:
+                deposits.append((str(client), str(tx)))
+            yield ('deposit', str(client), str(tx), f'{rng.randint(1, 100000) / 100}')
+
+def write_csv(out, rows, header: bool=True):
+    if header:
+        out.write('type,client,tx,amount\n')
+    out.writelines(f'{_type},{client},{tx},{amount}\n' for _type, client, tx, amount in rows)
+
+def open_output(path: str):
+    if path == '-':
+        return sys.stdout
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wt', compresslevel=1)
+    return open(path, 'w', buffering=1 << 20)
+
+def main():
+    parser = ArgumentParser(description='Write a synthetic transaction CSV.')
+    parser.add_argument('output', help="CSV path (.gz to compress) or '-' for stdout")
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--zipf', type=float, default=1.1, help='client skew exponent (0 is uniform)')
+    parser.add_argument('--withdrawal', type=float, default=0.3, help='fraction of rows')
+    parser.add_argument('--dispute', type=float, default=0.01, help='fraction of rows')
+    parser.add_argument('--resolve', type=float, default=0.005, help='fraction of rows')
+    parser.add_argument('--chargeback', type=float, default=0.002, help='fraction of rows')
+    parser.add_argument('--no-header', action='store_true')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rows = generate(args.rows, args.clients, args.zipf, args.withdrawal, args.dispute,
+                    args.resolve, args.chargeback, args.seed)
+    out = open_output(args.output)
+    try:
+        write_csv(out, rows, header=not args.no_header)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,63 @@
-from enum import Enum
-from decimal import Decimal, getcontext
-from csv import Sniffer, DictReader
-from sys import argv, exit
+from decimal import Context, Decimal, getcontext
+from sys import argv, byteorder, exit, stdin
+from itertools import chain, groupby, islice
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from functools import partial
+from operator import itemgetter
+from contextlib import ExitStack, contextmanager, nullcontext
+from time import perf_counter
+import io, os, struct, sys
 
 getcontext().prec = 4
 
-class TransactionType(Enum):
-    DEPOSIT = 'deposit'
-    WITHDRAWAL = 'withdrawal'
-    DISPUTE = 'dispute'
-    RESOLVE = 'resolve'
-    CHARGEBACK = 'chargeback'
+# Fixed-point amounts are integers counting 1/SCALE units (4 decimal places)
+SCALE = 10000
+
+def parse_amount(text: str) -> int:
+    """Parse a decimal string straight into fixed-point units.
+
+    Digits past the fourth decimal place are rounded half-even, like Decimal.
+    """
+    # Amounts under 1e11 with at most 4 decimals survive a trip through a
+    # double with error well under half a unit, so rounding recovers them
+    if len(text) <= 12 and '.' not in text[:-5]:
+        return round(float(text) * SCALE)
+    whole, _, frac = text.partition('.')
+    sign = -1 if whole.startswith('-') else 1
+    units = int(whole.lstrip('+-') or 0) * SCALE
+    if len(frac) > 4:
+        frac, rest = frac[:4], frac[4:].rstrip('0')
+        if rest > '5' or (rest == '5' and int(frac) % 2):
+            units += 1
+    return sign * (units + int(frac.ljust(4, '0')))
+
+def format_amount(units: int) -> str:
+    # Below 1e11 a double is off by far less than half the last place
+    if -10**15 < units < 10**15:
+        return f'{units / SCALE:.4f}'
+    sign = '-' if units < 0 else ''
+    whole, frac = divmod(abs(units), SCALE)
+    return f'{sign}{whole}.{frac:04d}'
+
+# Row types; deposits and withdrawals come first. The TransactionType Enum
+# of them is only created when first used, as importing enum is slow
+TYPE_CODES = DEPOSIT, WITHDRAWAL, DISPUTE, RESOLVE, CHARGEBACK = \
+    ('deposit', 'withdrawal', 'dispute', 'resolve', 'chargeback')
+
+def __getattr__(name: str):
+    if name == 'TransactionType':
+        global TransactionType
+        from enum import Enum
+        TransactionType = Enum('TransactionType', {_type.upper(): _type for _type in TYPE_CODES},
+                               module=__name__)
+        return TransactionType
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 	
 class Account():
+    __slots__ = ('_client_id', '_total', '_available', '_held', '_locked')
+
     def __init__(self, client_id: int):
         self._client_id = client_id
         self._total = Decimal(0)
@@ -60,60 +105,52 @@ class Account():
     def locked(self, new_locked):
         self._locked = new_locked
         
-        
+
+class FixedAccount(Account):
+    """Account whose balances are integer units of 1/SCALE instead of Decimal."""
+    __slots__ = ()
+
+    def __init__(self, client_id: int):
+        self._client_id = client_id
+        self._total = 0
+        self._available = 0
+        self._held = 0
+        self._locked = False
+
+    def __str__(self):
+        return f'{self._client_id}, {format_amount(self._available)}, ' \
+               f'{format_amount(self._held)}, {format_amount(self._total)}, {self._locked}'
+
+    @Account.total.setter
+    def total(self, new_total):
+        self._total = new_total
+
+    @Account.available.setter
+    def available(self, new_available):
+        self._available = new_available
+
+    @Account.held.setter
+    def held(self, new_held):
+        self._held = new_held
+
+
 class Transaction():
-    def __init__(self, _type: TransactionType, client_id: int, tx_id: int, amount: Decimal=0):
+    __slots__ = ('_type', '_client_id', '_tx_id', '_amount')
+    account_class = Account
+    parse_amount = Decimal
+
+    def __init__(self, _type: str, client_id: int, tx_id: int, amount: Decimal=0):
         self._type = _type
         self._client_id = client_id
         self._tx_id = tx_id
         self._amount = amount
-        # If new client, create account
-        if client_id not in accounts:
-            accounts[client_id] = Account(client_id)
-        # Ignore frozen accounts
-        if accounts[client_id].locked:
-            return         
-        if _type == TransactionType.DEPOSIT.value:
-            accounts[client_id].total += amount
-            accounts[client_id].available += amount
-        elif _type == TransactionType.WITHDRAWAL.value:
-            # Don't allow withdrawal of more than available (all or nothing)
-            if Decimal(amount) <= Decimal(accounts[client_id].available):
-                accounts[client_id].total -= amount
-                accounts[client_id].available -= amount
-        elif _type == TransactionType.DISPUTE.value:
-            # Do nothing if we can't find the tx_id
-            if tx_id in transactions:
-                # Also do nothing if this client is disputing another client
-                if client_id == transactions[tx_id].client_id:
-                    # Only handle disputing deposits
-                    if transactions[tx_id].tx_type == TransactionType.DEPOSIT.value:
-                        accounts[client_id].available -= transactions[tx_id].amount
-                        accounts[client_id].held += transactions[tx_id].amount
-        elif _type == TransactionType.RESOLVE.value:
-            # Do nothing if we can't find the tx_id
-            if tx_id in transactions:
-                # Also do nothing if this client is resolving another client
-                if client_id == transactions[tx_id].client_id:
-                    # This may have been resolved or chargedback already
-                    if accounts[client_id].held > 0:
-                        # Only handle resolving deposits
-                        if transactions[tx_id].tx_type == TransactionType.DEPOSIT.value:
-                            accounts[client_id].available += transactions[tx_id].amount
-                            accounts[client_id].held -= transactions[tx_id].amount
-        elif _type == TransactionType.CHARGEBACK.value:
-            # Do nothing if we can't find the tx_id
-            if tx_id in transactions:
-                # Also do nothing if this client is charging back another client
-                if client_id == transactions[tx_id].client_id:
-                    # This may have been resolved or chargedback already
-                    if accounts[client_id].held > 0:
-                        # Only handle chargeback on deposits
-                        if transactions[tx_id].tx_type == TransactionType.DEPOSIT.value:
-                            accounts[client_id].total -= transactions[tx_id].amount
-                            accounts[client_id].held -= transactions[tx_id].amount
-                            accounts[client_id].locked = True
-                    
+        # Apply to the module-level accounts and transactions. Like Engine,
+        # a row of unknown type changes nothing, not even opening an account
+        engine = _module_engine(self.account_class)
+        effect = engine.effects.get(_type)
+        if effect is not None:
+            effect(client_id, tx_id, amount)
+
     def __str__(self):
         return f"<TransactionType='{self._type}', ID='{self._tx_id}', " \
                f"Client='{self._client_id}', Amount='{self._amount}'>"
@@ -134,39 +171,1341 @@ class Transaction():
     def amount(self):
         return self._amount
 
+
+class FixedTransaction(Transaction):
+    """Transaction applied to FixedAccount balances with integer amounts."""
+    __slots__ = ()
+    account_class = FixedAccount
+    parse_amount = staticmethod(parse_amount)
+
+
+class StoredTransaction():
+    """What a dispute needs to know about an earlier deposit or withdrawal."""
+    __slots__ = ('tx_type', 'client_id', 'amount')
+
+    def __init__(self, tx_type: str, client_id: int, amount):
+        self.tx_type = tx_type
+        self.client_id = client_id
+        self.amount = amount
+
+
+class TransactionStore():
+    """Compact tx_id -> (client, amount, type) index for dispute lookups.
+
+    A drop-in for the transactions dict that keeps parallel columns in pages
+    of PAGE_SIZE consecutive tx ids instead of a Transaction object per entry.
+    Fixed-point amounts live in an int64 array; Decimal amounts in a list.
+    Pages are allocated on first use and are small, so an id scattered far
+    from the others costs a few KB rather than a column of 64K slots.
+    A deposit's dispute state shares the kind byte, above STATE_SHIFT.
+    """
+    __slots__ = ('_pages', '_fixed', '_len')
+    PAGE_BITS = 8
+    PAGE_SIZE = 1 << PAGE_BITS
+    KINDS = (None, DEPOSIT, WITHDRAWAL)
+    STATE_SHIFT = 2
+
+    def __init__(self, fixed: bool=False):
+        self._pages = {}
+        self._fixed = fixed
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, tx_id: int):
+        page = self._pages.get(tx_id >> self.PAGE_BITS)
+        return page is not None and page[0][tx_id & (self.PAGE_SIZE - 1)] != 0
+
+    def __getitem__(self, tx_id: int):
+        stored = self.get(tx_id)
+        if stored is None:
+            raise KeyError(tx_id)
+        return stored
+
+    def get(self, tx_id: int, default=None):
+        page = self._pages.get(tx_id >> self.PAGE_BITS)
+        if page is None:
+            return default
+        slot = tx_id & (self.PAGE_SIZE - 1)
+        kinds, clients, amounts = page
+        if not kinds[slot]:
+            return default
+        return StoredTransaction(self.KINDS[kinds[slot] & 3], clients[slot], amounts[slot])
+
+    def __setitem__(self, tx_id: int, transx):
+        self.add(tx_id, transx.tx_type, transx.client_id, transx.amount)
+
+    def add(self, tx_id: int, tx_type: str, client_id: int, amount):
+        if not 0 <= tx_id <= 0xFFFFFFFF:
+            raise ValueError(f'tx id {tx_id} is not a u32')
+        page = self._pages.get(tx_id >> self.PAGE_BITS)
+        if page is None:
+            page = self._pages[tx_id >> self.PAGE_BITS] = self._new_page()
+        slot = tx_id & (self.PAGE_SIZE - 1)
+        kinds, clients, amounts = page
+        kind = self.KINDS.index(tx_type)
+        # The kind byte marks the slot as used, so it goes last: a client or
+        # amount out of range raises before anything is recorded
+        clients[slot] = client_id
+        amounts[slot] = amount
+        if not kinds[slot]:
+            self._len += 1
+        kinds[slot] = kind
+
+    def state(self, tx_id: int) -> int:
+        page = self._pages.get(tx_id >> self.PAGE_BITS)
+        return 0 if page is None else page[0][tx_id & (self.PAGE_SIZE - 1)] >> self.STATE_SHIFT
+
+    def set_state(self, tx_id: int, state: int):
+        kinds = self._pages[tx_id >> self.PAGE_BITS][0]
+        slot = tx_id & (self.PAGE_SIZE - 1)
+        kinds[slot] = kinds[slot] & 3 | state << self.STATE_SHIFT
+
+    def columns(self, page_no: int):
+        """The (kinds, clients, amounts) columns of a page, allocated if need be.
+
+        For bulk writers, which must call added() with the number of slots
+        they fill that were empty.
+        """
+        page = self._pages.get(page_no)
+        if page is None:
+            page = self._pages[page_no] = self._new_page()
+        return page
+
+    def added(self, count: int):
+        self._len += count
+
+    def _new_page(self):
+        size = self.PAGE_SIZE
+        amounts = array('q', bytes(8 * size)) if self._fixed else [None] * size
+        return (bytearray(size), array('I', bytes(4 * size)), amounts)
+
+
+class Engine():
+    """A ledger that owns its accounts and the transactions they can dispute.
+
+    apply_batch() takes (type, client, tx, amount) string rows as produced by
+    read_rows(). Deposits and withdrawals with a tx id already seen, and
+    disputes, resolves and chargebacks of an unknown tx id, are ignored;
+    everything else is dispatched through the effects table keyed by type.
+
+    Each deposit moves through the dispute states NORMAL -> DISPUTED ->
+    RESOLVED (which may be disputed again) or CHARGEDBACK. The state lives in
+    the transaction store; open disputes are also indexed by client in
+    disputes, with their total in total_held.
+    """
+    def __init__(self, fixed: bool=False, accounts: dict=None, transactions=None):
+        self.fixed = fixed
+        self.accounts = {} if accounts is None else accounts
+        self.transactions = TransactionStore(fixed) if transactions is None else transactions
+        self.account_class = FixedAccount if fixed else Account
+        self.parse_amount = parse_amount if fixed else Decimal
+        # client_id -> {tx_id: amount} of its open disputes
+        self.disputes = {}
+        self.total_held = 0
+        # Dispute states for stores that cannot keep them, such as a dict
+        # of Transactions; only states other than NORMAL are kept
+        self._states = None if hasattr(self.transactions, 'set_state') else {}
+        # A Metrics instance to count and time apply_batch(), if wanted
+        self.metrics = None
+        self.effects = {
+            DEPOSIT: self.deposit,
+            WITHDRAWAL: self.withdraw,
+            DISPUTE: self.dispute,
+            RESOLVE: self.resolve,
+            CHARGEBACK: self.chargeback,
+        }
+
+    def apply(self, row):
+        self.apply_batch((row,))
+
+    def apply_batch(self, rows):
+        if self.metrics is not None:
+            return self._apply_batch_measured(rows)
+        transactions, effects, parse = self.transactions, self.effects, self.parse_amount
+        for _type, client, tx, amount in rows:
+            tx_id = int(tx)
+            if _type in RECORDED:
+                # If tx_id already recorded, ignore deposits and withdrawals
+                if tx_id in transactions:
+                    continue
+                amount = parse(amount)
+                transactions.add(tx_id, _type, int(client), amount)
+            # Disputes, resolves and chargebacks need a recorded tx_id
+            elif tx_id not in transactions:
+                continue
+            effect = effects.get(_type)
+            if effect is not None:
+                effect(int(client), tx_id, amount)
+
+    def apply_chunk(self, chunk):
+        """apply_batch() for the typed columns made by parse_chunk()."""
+        if self.metrics is not None:
+            return self._apply_chunk_measured(chunk)
+        codes, clients, txs, amounts = chunk
+        transactions = self.transactions
+        effects = [self.effects[_type] for _type in TYPE_CODES]
+        for code, client_id, tx_id, amount in zip(codes, clients, txs, amounts):
+            if code <= WITHDRAWAL_CODE:
+                if tx_id in transactions:
+                    continue
+                transactions.add(tx_id, TYPE_CODES[code], client_id, amount)
+            elif tx_id not in transactions:
+                continue
+            effects[code](client_id, tx_id, amount)
+
+    def _apply_chunk_measured(self, chunk):
+        """apply_chunk() with the store and apply stages timed and every row
+        and rejection counted, like _apply_batch_measured()."""
+        codes, clients, txs, amounts = chunk
+        transactions = self.transactions
+        effects = [self.effects[_type] for _type in TYPE_CODES]
+        metrics = self.metrics
+        stages, counts, rejected = metrics.stages, metrics.rows, metrics.rejected
+        sample_every = metrics.sample_every
+        clock = perf_counter
+        for code, client_id, tx_id, amount in zip(codes, clients, txs, amounts):
+            start = clock()
+            _type = TYPE_CODES[code]
+            counts[_type] += 1
+            if code <= WITHDRAWAL_CODE:
+                if tx_id in transactions:
+                    rejected[REJECT_DUPLICATE_TX] += 1
+                    stages['store'] += clock() - start
+                    continue
+                transactions.add(tx_id, _type, client_id, amount)
+            elif tx_id not in transactions:
+                rejected[REJECT_UNKNOWN_TX] += 1
+                stages['store'] += clock() - start
+                continue
+            stored = clock()
+            stages['store'] += stored - start
+            reason = effects[code](client_id, tx_id, amount)
+            done = clock()
+            stages['apply'] += done - stored
+            if reason is not None:
+                rejected[reason] += 1
+            if counts[_type] % sample_every == 0:
+                metrics.observe(_type, done - start)
+
+    def _apply_batch_measured(self, rows):
+        """apply_batch() with every stage timed and every row counted.
+
+        Kept separate so that the unmeasured loop pays nothing for metrics.
+        """
+        transactions, effects, parse = self.transactions, self.effects, self.parse_amount
+        metrics = self.metrics
+        stages, counts, rejected = metrics.stages, metrics.rows, metrics.rejected
+        sample_every = metrics.sample_every
+        clock = perf_counter
+        rows = iter(rows)
+        while True:
+            start = clock()
+            row = next(rows, None)
+            parsed = clock()
+            stages['read'] += parsed - start
+            if row is None:
+                return
+            _type, client, tx, amount = row
+            tx_id = int(tx)
+            if _type not in TYPES:
+                # Types come from the input, so unknown ones share a label;
+                # they are ignored rather than rejected
+                counts[Metrics.OTHER] += 1
+                stages['store'] += clock() - parsed
+                continue
+            counts[_type] += 1
+            if _type in RECORDED:
+                if tx_id in transactions:
+                    rejected[REJECT_DUPLICATE_TX] += 1
+                    stages['store'] += clock() - parsed
+                    continue
+                before = clock()
+                amount = parse(amount)
+                after = clock()
+                stages['amount'] += after - before
+                transactions.add(tx_id, _type, int(client), amount)
+                stored = clock()
+                stages['store'] += stored - after + before - parsed
+            elif tx_id not in transactions:
+                rejected[REJECT_UNKNOWN_TX] += 1
+                stages['store'] += clock() - parsed
+                continue
+            else:
+                stored = clock()
+                stages['store'] += stored - parsed
+            effect = effects.get(_type)
+            if effect is None:
+                continue
+            reason = effect(int(client), tx_id, amount)
+            done = clock()
+            stages['apply'] += done - stored
+            if reason is not None:
+                rejected[reason] += 1
+            if counts[_type] % sample_every == 0:
+                metrics.observe(_type, done - parsed)
+
+    def open_account(self, client_id: int):
+        account = self.accounts.get(client_id)
+        if account is None:
+            account = self.accounts[client_id] = self.account_class(client_id)
+        return account
+
+    # Each effect returns None if it was applied, or why it was not
+
+    def deposit(self, client_id: int, tx_id: int, amount):
+        account = self.accounts.get(client_id) or self.open_account(client_id)
+        # Ignore frozen accounts
+        if account.locked:
+            return REJECT_LOCKED
+        account.total += amount
+        account.available += amount
+
+    def withdraw(self, client_id: int, tx_id: int, amount):
+        account = self.accounts.get(client_id) or self.open_account(client_id)
+        # Ignore frozen accounts
+        if account.locked:
+            return REJECT_LOCKED
+        # Don't allow withdrawal of more than available (all or nothing)
+        if amount > account.available:
+            return REJECT_OVERDRAW
+        account.total -= amount
+        account.available -= amount
+
+    def _disputed(self, client_id: int, tx_id: int):
+        """The account and deposit a dispute, resolve or chargeback refers to,
+        or the reason there is none."""
+        account = self.accounts.get(client_id) or self.open_account(client_id)
+        if account.locked:
+            return account, None, REJECT_LOCKED
+        # Do nothing if we can't find the tx_id, if this client is disputing
+        # another client, or if it isn't a deposit
+        disputed = self.transactions.get(tx_id)
+        if disputed is None:
+            return account, None, REJECT_UNKNOWN_TX
+        if disputed.client_id != client_id:
+            return account, None, REJECT_CROSS_CLIENT
+        if disputed.tx_type != DEPOSIT:
+            return account, None, REJECT_NOT_DEPOSIT
+        return account, disputed, None
+
+    def state(self, tx_id: int) -> int:
+        """The dispute state of a recorded transaction."""
+        states = self._states
+        return self.transactions.state(tx_id) if states is None else states.get(tx_id, NORMAL)
+
+    def _set_state(self, tx_id: int, state: int):
+        if self._states is None:
+            self.transactions.set_state(tx_id, state)
+        else:
+            self._states[tx_id] = state
+
+    def open_disputes(self, client_id: int=None):
+        """(client_id, tx_id, amount) for the open disputes of one client, or all."""
+        if client_id is not None:
+            return [(client_id, tx_id, amount)
+                    for tx_id, amount in self.disputes.get(client_id, {}).items()]
+        return [(client, tx_id, amount) for client, open_ in self.disputes.items()
+                for tx_id, amount in open_.items()]
+
+    def dispute(self, client_id: int, tx_id: int, amount=None):
+        account, disputed, reason = self._disputed(client_id, tx_id)
+        if disputed is None:
+            return reason
+        state = self.state(tx_id)
+        if state == DISPUTED:
+            return REJECT_ALREADY_DISPUTED
+        if state == CHARGEDBACK:
+            return REJECT_CHARGEDBACK
+        self._set_state(tx_id, DISPUTED)
+        open_ = self.disputes.get(client_id)
+        if open_ is None:
+            open_ = self.disputes[client_id] = {}
+        open_[tx_id] = disputed.amount
+        self.total_held += disputed.amount
+        account.available -= disputed.amount
+        account.held += disputed.amount
+
+    def _settle(self, client_id: int, tx_id: int, state: int):
+        """Close an open dispute; returns the account and amount, or the
+        reason there is none."""
+        account, disputed, reason = self._disputed(client_id, tx_id)
+        if disputed is None:
+            return account, None, reason
+        # This may have been resolved or chargedback already
+        if self.state(tx_id) != DISPUTED:
+            return account, None, REJECT_NOT_DISPUTED
+        self._set_state(tx_id, state)
+        open_ = self.disputes[client_id]
+        del open_[tx_id]
+        if not open_:
+            del self.disputes[client_id]
+        self.total_held -= disputed.amount
+        return account, disputed.amount, None
+
+    def resolve(self, client_id: int, tx_id: int, amount=None):
+        account, amount, reason = self._settle(client_id, tx_id, RESOLVED)
+        if amount is None:
+            return reason
+        account.available += amount
+        account.held -= amount
+
+    def chargeback(self, client_id: int, tx_id: int, amount=None):
+        account, amount, reason = self._settle(client_id, tx_id, CHARGEDBACK)
+        if amount is None:
+            return reason
+        account.total -= amount
+        account.held -= amount
+        account.locked = True
+
+
+class KernelEngine(Engine):
+    """A fixed-point Engine whose apply loop is engine_kernel's.
+
+    engine_kernel runs compiled if it has been built with mypyc, and as
+    plain Python otherwise. With metrics attached, or a store other than a
+    TransactionStore, Engine's own loop is used.
+    """
+    def __init__(self, accounts: dict=None, transactions=None):
+        super().__init__(True, accounts, transactions)
+
+    def _kernel(self):
+        if self.metrics is not None or not isinstance(self.transactions, TransactionStore):
+            return None
+        from engine_kernel import Kernel
+        return Kernel(self)
+
+    def apply_batch(self, rows):
+        kernel = self._kernel()
+        if kernel is None:
+            return super().apply_batch(rows)
+        kernel.apply_batch(rows)
+
+    def apply_chunk(self, chunk):
+        kernel = self._kernel()
+        if kernel is None:
+            return super().apply_chunk(chunk)
+        kernel.apply_chunk(*chunk)
+
+
+class Metrics():
+    """Optional counters and timings for an Engine, off unless attached.
+
+    Counts rows by type (unknown types together as OTHER) and rejected rows
+    by reason, accumulates seconds per
+    stage (read, amount, store, apply, plus any timed with stage()), and
+    keeps a latency histogram per type from every sample_every-th row.
+    gauges maps further metric names to functions that read their value.
+    """
+    # Upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 1e-3, float('inf'))
+    # The type label of rows whose type is not one of TYPES
+    OTHER = 'other'
+
+    def __init__(self, sample_every: int=100):
+        self.sample_every = sample_every
+        self.rows = Counter()
+        self.rejected = Counter()
+        self.stages = defaultdict(float)
+        self.latency = {}
+        self.gauges = {}
+
+    def observe(self, _type: str, seconds: float):
+        histogram = self.latency.get(_type)
+        if histogram is None:
+            histogram = self.latency[_type] = [0] * len(self.BUCKETS) + [0.0]
+        histogram[bisect_left(self.BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += perf_counter() - start
+
+    def to_json(self) -> str:
+        import json
+        return json.dumps({
+            'rows': self.rows,
+            'rejected': self.rejected,
+            'stage_seconds': self.stages,
+            'row_latency_seconds': {
+                _type: {'buckets': dict(zip(map(str, self.BUCKETS), histogram)),
+                        'sum': histogram[-1]}
+                for _type, histogram in self.latency.items()},
+            'gauges': {name: read() for name, read in self.gauges.items()},
+        }, indent=2)
+
+    @staticmethod
+    def label(value: str) -> str:
+        """value escaped for a label in the Prometheus text format."""
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def to_prometheus(self) -> str:
+        label = self.label
+        lines = ['# TYPE payment_engine_rows_total counter']
+        lines += [f'payment_engine_rows_total{{type="{label(_type)}"}} {count}'
+                  for _type, count in sorted(self.rows.items())]
+        lines.append('# TYPE payment_engine_rejected_total counter')
+        lines += [f'payment_engine_rejected_total{{reason="{label(reason)}"}} {count}'
+                  for reason, count in sorted(self.rejected.items())]
+        lines.append('# TYPE payment_engine_stage_seconds_total counter')
+        lines += [f'payment_engine_stage_seconds_total{{stage="{label(stage)}"}} {seconds:.6f}'
+                  for stage, seconds in sorted(self.stages.items())]
+        lines.append('# TYPE payment_engine_row_latency_seconds histogram')
+        for _type, histogram in sorted(self.latency.items()):
+            _type = label(_type)
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, histogram):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'payment_engine_row_latency_seconds_bucket{{type="{_type}",le="{le}"}} {cumulative}')
+            lines.append(f'payment_engine_row_latency_seconds_sum{{type="{_type}"}} {histogram[-1]:.9f}')
+            lines.append(f'payment_engine_row_latency_seconds_count{{type="{_type}"}} {cumulative}')
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f'# TYPE payment_engine_{name} gauge')
+            lines.append(f'payment_engine_{name} {read()}')
+        return '\n'.join(lines) + '\n'
+
+
 accounts = {}
-transactions = {}        
+transactions = TransactionStore()
+_module_engines = {}
+
+def _module_engine(account_class):
+    """An Engine over the current module-level accounts and transactions."""
+    engine = _module_engines.get(account_class)
+    if engine is None or engine.accounts is not accounts or engine.transactions is not transactions:
+        engine = _module_engines[account_class] = Engine(
+            account_class is FixedAccount, accounts, transactions)
+    return engine
+
+FIELDS = ('type', 'client', 'tx', 'amount')
+GZIP_MAGIC = b'\x1f\x8b'
+TYPES = frozenset(TYPE_CODES)
+# Row types are their index in TYPE_CODES in parse_chunk() columns
+WITHDRAWAL_CODE = TYPE_CODES.index(WITHDRAWAL)
+# Reasons Engine rejects a row, as counted by Metrics
+REJECT_DUPLICATE_TX = 'duplicate_tx'
+REJECT_UNKNOWN_TX = 'unknown_tx'
+REJECT_LOCKED = 'locked_account'
+REJECT_OVERDRAW = 'overdraw'
+REJECT_CROSS_CLIENT = 'cross_client_dispute'
+REJECT_NOT_DEPOSIT = 'not_a_deposit'
+REJECT_NOT_DISPUTED = 'not_disputed'
+REJECT_ALREADY_DISPUTED = 'already_disputed'
+REJECT_CHARGEDBACK = 'chargedback'
+
+# Dispute states of a deposit
+NORMAL, DISPUTED, RESOLVED, CHARGEDBACK = range(4)
+# Row types that are recorded in transactions for later disputes
+RECORDED = frozenset((DEPOSIT, WITHDRAWAL))
+
+def open_input(path: str):
+    """Open a path (or '-' for stdin) as text, transparently gunzipping."""
+    raw = stdin.buffer if path == '-' else open(path, 'rb')
+    if not hasattr(raw, 'peek'):
+        raw = io.BufferedReader(raw)
+    if raw.peek(2)[:2] == GZIP_MAGIC:
+        import gzip
+        raw = gzip.GzipFile(fileobj=raw)
+    return io.TextIOWrapper(raw, encoding='utf-8', newline='')
+
+def read_rows(csvfile):
+    """Stream (type, client, tx, amount) string tuples from an open file.
+
+    The header, if any, is detected from the first line of the same handle,
+    so the input is read exactly once and can be a pipe. A first line is a
+    header only if it names every one of FIELDS; otherwise it is a row.
+    Missing amounts (disputes, resolves, chargebacks) come back as ''.
+    """
+    first = csvfile.readline()
+    names = [f.strip().lower() for f in first.split(',')]
+    order = None
+    if not set(FIELDS).issubset(names):
+        lines = chain((first,), csvfile)
+    else:
+        # First line is a header, honour its column order
+        lines = csvfile
+        if names[:4] != list(FIELDS):
+            order = tuple(names.index(name) for name in FIELDS)
+    for line in lines:
+        fields = line.rstrip('\r\n').split(',')
+        if len(fields) != 4 or ' ' in line or order:
+            if not line.strip():
+                continue
+            fields = [f.strip() for f in fields] + [''] * (4 - len(fields))
+            if order:
+                fields = [fields[i] for i in order]
+            fields = fields[:4]
+        yield tuple(fields)
+
+def read_sequenced_rows(csvfile, column: str):
+    """Stream (sequence key, row) pairs from a file whose header has a column
+    to order rows by, such as a sequence number or a timestamp.
+
+    Keys are numbers when the column holds numbers and strings otherwise,
+    so ISO-8601 timestamps order correctly too. A file must use one kind
+    throughout: a blank key, or a number among text keys or the other way
+    round, is a ValueError naming the line.
+    """
+    names = [f.strip().lower() for f in csvfile.readline().split(',')]
+    for name in FIELDS + (column,):
+        if name not in names:
+            raise ValueError(f'no {name} column in the header')
+    order = [names.index(name) for name in FIELDS] + [names.index(column)]
+    width = len(names)
+    numeric = None
+    for number, line in enumerate(csvfile, 2):
+        if not line.strip():
+            continue
+        fields = [f.strip() for f in line.rstrip('\r\n').split(',')]
+        fields += [''] * (width - len(fields))
+        value = fields[order[4]]
+        if not value:
+            raise ValueError(f'line {number}: blank {column}')
+        key = _sequence_key(value)
+        if numeric is None:
+            numeric = not isinstance(key, str)
+        elif numeric == isinstance(key, str):
+            raise ValueError(f'line {number}: {column} {value!r} is not a '
+                             f'{"number" if numeric else "text"} key like the rows before it')
+        yield key, tuple(fields[i] for i in order[:4])
+
+def _sequence_key(value: str):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+def process_row(_type: str, client_id: int, tx_id: int, amount: str, tx_class=Transaction):
+    """Apply one row to the module-level accounts and transactions."""
+    # If tx_id already recorded, ignore deposits and withdrawals
+    if tx_id in transactions:
+        if _type in RECORDED:
+            return
+    # If tx_id NOT already recorded, can only be deposits and withdrawals
+    elif _type not in RECORDED:
+        return
+    if _type in RECORDED:
+        # These need to be added to the transactions
+        transactions[tx_id] = tx_class(_type, client_id, tx_id, tx_class.parse_amount(amount))
+    else:
+        # Not adding disputes, resolves, or chargebacks to transactions
+        tx_class(_type, client_id, tx_id, 0)
+
+class TxIdSet():
+    """Paged bitset of u32 tx ids, a few bits per id instead of a dict entry."""
+    __slots__ = ('_pages',)
+
+    def __init__(self):
+        self._pages = {}
+
+    def __contains__(self, tx_id: int):
+        page = self._pages.get(tx_id >> 16)
+        return page is not None and bool(page[(tx_id & 0xFFFF) >> 3] >> (tx_id & 7) & 1)
+
+    def add(self, tx_id: int):
+        page = self._pages.get(tx_id >> 16)
+        if page is None:
+            page = self._pages[tx_id >> 16] = bytearray(8192)
+        page[(tx_id & 0xFFFF) >> 3] |= 1 << (tx_id & 7)
+
+
+SNAPSHOT_MAGIC = b'PAYSNAP2'
+# magic, fixed, little-endian, page bits, accounts, pages, transactions
+SNAPSHOT_HEADER = struct.Struct('=8sBBHQQQ')
+
+def _pad8(out):
+    out.write(bytes(-out.tell() % 8))
+
+def _write_text(out, values):
+    blob = '\n'.join('' if value is None else str(value) for value in values).encode()
+    out.write(struct.pack('=Q', len(blob)))
+    out.write(blob)
+    _pad8(out)
+
+def write_snapshot(engine: Engine, path: str):
+    """Save an engine's complete state to a compact binary file.
+
+    Accounts are written as columns, and each TransactionStore page as its
+    raw column bytes, so read_snapshot() can map them back in without
+    parsing. Decimal amounts have no fixed width and are written as text.
+    The tx ids of open disputes follow, to rebuild the dispute index from.
+    The file is replaced atomically.
+    """
+    store = engine.transactions
+    if not isinstance(store, TransactionStore):
+        raise TypeError(f'cannot snapshot a {type(store).__name__}')
+    accts = list(engine.accounts.values())
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as out:
+        out.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, engine.fixed, byteorder == 'little',
+                                       store.PAGE_BITS, len(accts), len(store._pages), len(store)))
+        out.write(array('I', [acct.client_id for acct in accts]).tobytes())
+        out.write(bytes(acct.locked for acct in accts))
+        _pad8(out)
+        for column in ('available', 'held', 'total'):
+            values = [getattr(acct, column) for acct in accts]
+            if engine.fixed:
+                out.write(array('q', values).tobytes())
+            else:
+                _write_text(out, values)
+        for page_no in sorted(store._pages):
+            kinds, clients, amounts = store._pages[page_no]
+            out.write(struct.pack('=Q', page_no))
+            out.write(kinds)
+            _pad8(out)
+            out.write(clients)
+            if engine.fixed:
+                out.write(amounts)
+            else:
+                _write_text(out, amounts)
+        disputed = array('I', [tx_id for _, tx_id, _ in engine.open_disputes()])
+        out.write(struct.pack('=Q', len(disputed)))
+        out.write(disputed.tobytes())
+        _pad8(out)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp, path)
+
+def read_snapshot(path: str) -> Engine:
+    """Load an Engine saved by write_snapshot().
+
+    With fixed-point amounts the transaction pages are private copy-on-write
+    views of the memory-mapped file, so loading costs nothing per transaction
+    and pages are only read from disk when a dispute touches them.
+    """
+    import mmap
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    view = memoryview(mm)
+    magic, fixed, little, page_bits, n_accts, n_pages, n_tx = SNAPSHOT_HEADER.unpack_from(view)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError(f'{path} is not a payment engine snapshot')
+    if little != (byteorder == 'little') or page_bits != TransactionStore.PAGE_BITS:
+        raise ValueError(f'{path} was written on an incompatible platform')
+    engine = Engine(bool(fixed))
+    pos = SNAPSHOT_HEADER.size
+
+    def take(size):
+        nonlocal pos
+        chunk = view[pos:pos + size]
+        pos += size
+        return chunk
+
+    def take_text(count):
+        nonlocal pos
+        (size,) = struct.unpack_from('=Q', view, pos)
+        pos += 8
+        values = str(take(size), 'ascii').split('\n') if count else []
+        pos += -pos % 8
+        return [Decimal(value) if value else None for value in values]
 
-def main():
-    if len(argv) < 2:
+    clients = take(4 * n_accts).cast('I')
+    locked = take(n_accts)
+    pos += -pos % 8
+    columns = []
+    for _ in range(3):
+        columns.append(take(8 * n_accts).cast('q') if fixed else take_text(n_accts))
+    for i, (available, held, total) in enumerate(zip(*columns)):
+        acct = engine.open_account(clients[i])
+        acct.available, acct.held, acct.total = available, held, total
+        acct.locked = bool(locked[i])
+    store = engine.transactions
+    size = store.PAGE_SIZE
+    for _ in range(n_pages):
+        (page_no,) = struct.unpack_from('=Q', view, pos)
+        pos += 8
+        kinds = take(size)
+        pos += -pos % 8
+        page_clients = take(4 * size).cast('I')
+        amounts = take(8 * size).cast('q') if fixed else take_text(size)
+        store._pages[page_no] = (kinds, page_clients, amounts)
+    store._len = n_tx
+    (n_disputes,) = struct.unpack_from('=Q', view, pos)
+    pos += 8
+    for tx_id in take(4 * n_disputes).cast('I'):
+        disputed = store[tx_id]
+        engine.disputes.setdefault(disputed.client_id, {})[tx_id] = disputed.amount
+        engine.total_held += disputed.amount
+    return engine
+
+REPORT_HEADER = 'client,available,held,total,locked\n'
+REPORT_MAGIC = b'PAYRPT1\n'
+# client, available, held, total (in 1/SCALE units), locked
+REPORT_RECORD = struct.Struct('<Iqqq?')
+REPORT_CHUNK = 65536
+_UNITS = Context(prec=64)
+
+def _units(amount) -> int:
+    """An amount as fixed-point units, whichever mode it came from."""
+    if isinstance(amount, int):
+        return amount
+    return int(amount.scaleb(4, _UNITS).to_integral_value(context=_UNITS))
+
+def _format_text(accts, amount):
+    return ''.join(f'{acct}\n' for acct in accts).encode()
+
+def _format_csv(accts, amount):
+    return ''.join(f'{acct.client_id},{amount(acct.available)},{amount(acct.held)},'
+                   f'{amount(acct.total)},{acct.locked}\n' for acct in accts).encode()
+
+def _format_jsonl(accts, amount):
+    return ''.join(f'{{"client": {acct.client_id}, "available": "{amount(acct.available)}", '
+                   f'"held": "{amount(acct.held)}", "total": "{amount(acct.total)}", '
+                   f'"locked": {"true" if acct.locked else "false"}}}\n' for acct in accts).encode()
+
+def _format_binary(accts, amount):
+    pack = REPORT_RECORD.pack
+    return b''.join(pack(acct.client_id, _units(acct.available), _units(acct.held),
+                         _units(acct.total), acct.locked) for acct in accts)
+
+REPORT_FORMATS = {'text': _format_text, 'csv': _format_csv, 'jsonl': _format_jsonl,
+                  'binary': _format_binary}
+
+def write_report(accts, out, fmt: str='text', sort: bool=False):
+    """Write accounts to a binary stream in REPORT_CHUNK-sized writes.
+
+    text is the classic report, csv the same columns without padding,
+    jsonl one object per account with amounts as strings, and binary a
+    REPORT_MAGIC header followed by little-endian REPORT_RECORDs with
+    amounts in 1/SCALE units.
+    """
+    if sort:
+        accts = sorted(accts, key=lambda acct: acct.client_id)
+    accts = iter(accts)
+    formatter = REPORT_FORMATS[fmt]
+    chunk = list(islice(accts, REPORT_CHUNK))
+    amount = format_amount if chunk and isinstance(chunk[0], FixedAccount) else str
+    if fmt == 'binary':
+        out.write(REPORT_MAGIC)
+    elif fmt in ('text', 'csv'):
+        out.write(REPORT_HEADER.encode())
+    while chunk:
+        out.write(formatter(chunk, amount))
+        chunk = list(islice(accts, REPORT_CHUNK))
+    out.flush()
+
+def read_binary_report(f):
+    """Yield (client, available, held, total, locked) from a binary report,
+    reading REPORT_CHUNK records at a time."""
+    if f.read(len(REPORT_MAGIC)) != REPORT_MAGIC:
+        raise ValueError('not a binary payment engine report')
+    size, unpack = REPORT_RECORD.size, REPORT_RECORD.iter_unpack
+    rest = b''
+    while True:
+        data = f.read(REPORT_CHUNK * size)
+        if not data:
+            break
+        data = rest + data if rest else data
+        whole = len(data) - len(data) % size
+        yield from unpack(memoryview(data)[:whole])
+        rest = data[whole:]
+    if rest:
+        raise ValueError('binary report ends in a partial record')
+
+SHARD_CHUNK = 8192
+
+def _shard_worker(conn, fixed: bool):
+    """Apply admitted rows for one shard of clients and send back its
+    accounts, or the exception a row raised."""
+    engine = Engine(fixed)
+    error = None
+    for chunk in iter(conn.recv, None):
+        # After a failure, keep reading so that the reader never blocks
+        # sending to a worker that stopped
+        if error is not None:
+            continue
+        try:
+            for _type, client_id, tx_id, amount in chunk:
+                # The tx may belong to another shard's client, but the
+                # single-process run still opens the disputing client's account
+                if _type in (DISPUTE, RESOLVE, CHARGEBACK):
+                    engine.open_account(client_id)
+            engine.apply_batch(chunk)
+        except Exception as e:
+            error = e
+    conn.send(list(engine.accounts.values()) if error is None else error)
+    conn.close()
+
+def run_sharded(rows, workers: int, fixed: bool=False):
+    """Apply rows across worker processes partitioned by client id.
+
+    Every row only touches its own client's account, except for the global
+    duplicate-tx and unknown-tx checks in Engine.apply_batch. The reader
+    keeps those here with a TxIdSet and forwards only admitted rows, so the
+    merged accounts come back exactly as the single-process run has them.
+    """
+    from multiprocessing import Pipe, Process
+    pipes, procs = [], []
+    for _ in range(workers):
+        parent, child = Pipe()
+        proc = Process(target=_shard_worker, args=(child, fixed), daemon=True)
+        proc.start()
+        child.close()
+        pipes.append(parent)
+        procs.append(proc)
+    buffers = [[] for _ in range(workers)]
+    seen = TxIdSet()
+    # Every admitted row opens its client's account, so this is the order
+    # the single-process run reports accounts in
+    opened = {}
+    for _type, client, tx, amount in rows:
+        # Engine ignores rows of unknown type, without opening an account
+        if _type not in TYPES:
+            continue
+        tx_id = int(tx)
+        if _type in RECORDED:
+            if tx_id in seen:
+                continue
+            seen.add(tx_id)
+        elif tx_id not in seen:
+            continue
+        client_id = int(client)
+        opened[client_id] = None
+        shard = buffers[client_id % workers]
+        shard.append((_type, client_id, tx_id, amount))
+        if len(shard) >= SHARD_CHUNK:
+            pipes[client_id % workers].send(shard)
+            buffers[client_id % workers] = []
+    for pipe, shard in zip(pipes, buffers):
+        if shard:
+            pipe.send(shard)
+        pipe.send(None)
+    merged, error = {}, None
+    for pipe in pipes:
+        accts = pipe.recv()
+        if isinstance(accts, BaseException):
+            error = error or accts
+        else:
+            merged.update((acct.client_id, acct) for acct in accts)
+    for proc in procs:
+        proc.join()
+    if error is not None:
+        raise error
+    return [merged[client_id] for client_id in opened]
+
+PIPELINE_CHUNK = 8192
+PIPELINE_QUEUE = 16
+
+def parse_chunk(rows, fixed: bool=False):
+    """Parse string rows into typed columns for Engine.apply_chunk().
+
+    Returns (codes, clients, txs, amounts): the type as an index into
+    TYPE_CODES, the ids as ints, and the amounts of deposits and withdrawals
+    parsed (0 for the other types). Rows of unknown type are dropped.
+    """
+    codes, clients, txs = bytearray(), array('q'), array('q')
+    amounts = array('q') if fixed else []
+    code_of = {_type: code for code, _type in enumerate(TYPE_CODES)}
+    parse = parse_amount if fixed else Decimal
+    for _type, client, tx, amount in rows:
+        tx_id = int(tx)
+        code = code_of.get(_type)
+        if code is None:
+            continue
+        codes.append(code)
+        clients.append(int(client))
+        txs.append(tx_id)
+        amounts.append(parse(amount) if code <= WITHDRAWAL_CODE else 0)
+    return codes, clients, txs, amounts
+
+def _pipeline_reader(rows, fixed: bool, chunk_size: int, put):
+    """The read/parse stage: put typed chunks, then a dict of its own timings
+    and of how many rows parse_chunk() dropped for their unknown type."""
+    busy = wait = 0.0
+    dropped = 0
+    try:
+        rows = iter(rows)
+        while True:
+            start = perf_counter()
+            batch = list(islice(rows, chunk_size))
+            if not batch:
+                break
+            try:
+                chunk = parse_chunk(batch, fixed)
+                dropped += len(batch) - len(chunk[0])
+            except (ValueError, ArithmeticError):
+                # Leave it to apply_batch(), which only parses what it
+                # admits, to raise at the right row or not at all
+                chunk = batch
+            ready = perf_counter()
+            busy += ready - start
+            put(chunk)
+            wait += perf_counter() - ready
+        put({'parse': busy, 'parse_wait': wait, 'dropped': dropped})
+    except BaseException as e:
+        put(e)
+
+def run_pipelined(rows, engine: Engine, process: bool=False, chunk_size: int=PIPELINE_CHUNK,
+                  queue_size: int=PIPELINE_QUEUE) -> dict:
+    """Apply rows to engine while a background stage reads and parses them.
+
+    The reader runs in a thread, which overlaps with applying while it waits
+    on I/O or decompression, or with process=True in a forked process, which
+    also parses in parallel. It hands typed chunks from parse_chunk()
+    through a bounded queue. Returns the seconds each stage spent busy and
+    waiting on the other: parse, parse_wait, apply and apply_wait. Rows
+    that parse_chunk() drops for their unknown type are still counted in
+    the engine's metrics, as Metrics.OTHER.
+    """
+    if process:
+        from multiprocessing import get_context
+        # Forked, so the reader can take over rows, even an open pipe
+        context = get_context('fork')
+        chunks = context.Queue(queue_size)
+        reader = context.Process(target=_pipeline_reader, daemon=True,
+                                 args=(rows, engine.fixed, chunk_size, chunks.put))
+    else:
+        from queue import Queue
+        from threading import Thread
+        chunks = Queue(queue_size)
+        reader = Thread(target=_pipeline_reader, daemon=True,
+                        args=(rows, engine.fixed, chunk_size, chunks.put))
+    reader.start()
+    busy = wait = 0.0
+    try:
+        while True:
+            start = perf_counter()
+            chunk = chunks.get()
+            got = perf_counter()
+            wait += got - start
+            if isinstance(chunk, dict):
+                break
+            if isinstance(chunk, BaseException):
+                raise chunk
+            if isinstance(chunk, list):
+                engine.apply_batch(chunk)
+            else:
+                engine.apply_chunk(chunk)
+            busy += perf_counter() - got
+    except BaseException:
+        # A thread blocked on a full queue dies with the process
+        if process:
+            reader.terminate()
+        raise
+    reader.join()
+    dropped = chunk.pop('dropped')
+    if engine.metrics is not None and dropped:
+        engine.metrics.rows[Metrics.OTHER] += dropped
+    return dict(chunk, apply=busy, apply_wait=wait)
+
+INPUT_SUFFIXES = ('.csv', '.csv.gz')
+
+def expand_inputs(paths) -> list:
+    """The input files named by paths, in order: a directory stands for its
+    .csv and .csv.gz files and a glob pattern for its matches, both sorted."""
+    import glob
+    files = []
+    for path in paths:
+        if path != '-' and os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.endswith(INPUT_SUFFIXES))
+        elif path != '-' and not os.path.exists(path) and glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+            if not matches:
+                raise FileNotFoundError(f'no files match {path}')
+            files += matches
+        else:
+            files.append(path)
+    return files
+
+def _parse_file(path: str, fixed: bool):
+    """Read and parse one input file in a pool worker: a parse_chunk()
+    chunk, or the raw rows if they do not all parse, left to apply_batch()
+    as in a single run."""
+    with open_input(path) as csvfile:
+        rows = list(read_rows(csvfile))
+    try:
+        return parse_chunk(rows, fixed)
+    except (ValueError, ArithmeticError):
+        return rows
+
+def _sort_file(path: str, fixed: bool, order_by: str, directory: str):
+    """Sort one input file by its order_by column (stably) in a pool worker.
+
+    The sorted rows are written to a file in directory as pickled frames of
+    (keys, parsed) for up to PIPELINE_CHUNK rows, parsed as by _parse_file().
+    Returns that file's path and whether the keys are numbers (None if the
+    file has no rows).
+    """
+    import pickle, tempfile
+    with open_input(path) as csvfile:
+        try:
+            keyed = sorted(read_sequenced_rows(csvfile, order_by), key=itemgetter(0))
+        except ValueError as e:
+            raise ValueError(f'{path}: {e}') from None
+    numeric = None if not keyed else not isinstance(keyed[0][0], str)
+    fd, sorted_path = tempfile.mkstemp(dir=directory)
+    with open(fd, 'wb', buffering=1 << 20) as out:
+        for start in range(0, len(keyed), PIPELINE_CHUNK):
+            frame = keyed[start:start + PIPELINE_CHUNK]
+            keys, rows = [key for key, _ in frame], [row for _, row in frame]
+            try:
+                parsed = list(zip(*parse_chunk(rows, fixed)))
+                keys = [key for key, row in zip(keys, rows) if row[0] in TYPES]
+            except (ValueError, ArithmeticError):
+                parsed = rows
+            pickle.dump((keys, parsed), out, pickle.HIGHEST_PROTOCOL)
+    return sorted_path, numeric
+
+def _read_sorted(path: str):
+    """Stream the (key, row) pairs of a file written by _sort_file()."""
+    import pickle
+    with open(path, 'rb') as frames:
+        while True:
+            try:
+                keys, parsed = pickle.load(frames)
+            except EOFError:
+                return
+            yield from zip(keys, parsed)
+
+def _apply_parsed(engine: Engine, rows):
+    """Apply raw rows and typed (code, client, tx, amount) rows, in order."""
+    for raw, group in groupby(rows, key=lambda row: row[0].__class__ is str):
+        while True:
+            batch = list(islice(group, PIPELINE_CHUNK))
+            if not batch:
+                break
+            if raw:
+                engine.apply_batch(batch)
+            else:
+                engine.apply_chunk(tuple(zip(*batch)))
+
+def _apply_file(engine: Engine, parsed):
+    if isinstance(parsed, list):
+        engine.apply_batch(parsed)
+    else:
+        engine.apply_chunk(parsed)
+
+def run_files(paths, engine: Engine, jobs: int=None, order_by: str=None):
+    """Apply many input files to engine, parsing them in a process pool.
+
+    Files are applied in the given order, exactly as if concatenated. With
+    order_by, rows are instead merged across files by that column; rows
+    with equal keys keep their file order, then their order in the file.
+    Each file is sorted in the pool and spilled to a scratch file, so the
+    merge only holds one frame of rows per file in memory.
+    """
+    import heapq, tempfile
+    from multiprocessing import Pool
+    with Pool(jobs) as pool:
+        if order_by is None:
+            # imap would parse ahead without limit; keep only a few files
+            # parsed and waiting at a time
+            pending = []
+            for path in paths:
+                pending.append(pool.apply_async(_parse_file, (path, engine.fixed)))
+                if len(pending) > (jobs or os.cpu_count() or 1):
+                    _apply_file(engine, pending.pop(0).get())
+            for result in pending:
+                _apply_file(engine, result.get())
+            return
+        with tempfile.TemporaryDirectory() as directory:
+            sort = partial(_sort_file, fixed=engine.fixed, order_by=order_by, directory=directory)
+            spilled = pool.map(sort, paths)
+            if len({numeric for _, numeric in spilled} - {None}) > 1:
+                raise ValueError(f'some files have number and others text {order_by} keys')
+            merged = heapq.merge(*(_read_sorted(path) for path, _ in spilled), key=itemgetter(0))
+            _apply_parsed(engine, map(itemgetter(1), merged))
+
+def main(args: list=None, out=None, err=None):
+    """Run the CLI on args (default: the command line), writing the report
+    to out (default: stdout) unless --output is given, and metrics to err
+    (default: stderr) unless --metrics-out is given."""
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Apply a CSV of transactions and print account balances.')
+    parser.add_argument('input', nargs='*',
+                        help="CSV files, optionally gzipped, directories of them or glob "
+                             "patterns, or '-' for stdin")
+    parser.add_argument('--jobs', type=int, metavar='N',
+                        help='with several input files, parse them in N processes '
+                             '(default: one per CPU)')
+    parser.add_argument('--order-by', metavar='COLUMN',
+                        help='apply the rows of all input files in the order of COLUMN '
+                             'instead of file by file')
+    parser.add_argument('--fixed', action='store_true',
+                        help='keep amounts as 4-place fixed-point integers instead of Decimal')
+    parser.add_argument('--numpy', action='store_true',
+                        help='apply rows in vectorized chunks with numpy (implies --fixed)')
+    parser.add_argument('--kernel', action='store_true',
+                        help='apply rows with engine_kernel, compiled if built (implies --fixed)')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='shard clients across N worker processes')
+    parser.add_argument('--pipeline', choices=('thread', 'process'),
+                        help='read and parse the input in a background thread or process')
+    parser.add_argument('--load-snapshot', metavar='PATH',
+                        help='start from a saved engine state and apply the input as a delta')
+    parser.add_argument('--save-snapshot', metavar='PATH',
+                        help='save the engine state after applying the input')
+    parser.add_argument('--spill', metavar='PATH',
+                        help='keep only recent transactions in memory and spill the rest to '
+                             'a SQLite file at PATH')
+    parser.add_argument('--overwrite-spill', action='store_true',
+                        help='with --spill, replace an existing file at PATH')
+    parser.add_argument('--cache-size', type=int, default=1_000_000, metavar='N',
+                        help='with --spill, transactions kept in memory (default: 1000000)')
+    parser.add_argument('--wal', metavar='DIR',
+                        help='log applied rows to DIR, recovering the state already there first')
+    parser.add_argument('--sync-every', type=int, default=1024, metavar='N',
+                        help='with --wal, fsync the log once per N rows (default: 1024)')
+    parser.add_argument('--compact-every', type=int, default=1_000_000, metavar='N',
+                        help='with --wal, fold the log into a snapshot every N rows '
+                             '(default: 1000000)')
+    parser.add_argument('--resume', action='store_true',
+                        help='with --wal, skip the input rows already applied, to finish a run '
+                             'over the same input that was interrupted')
+    parser.add_argument('--query-socket', metavar='PATH',
+                        help='answer balance queries on a Unix socket at PATH during the run')
+    parser.add_argument('--format', choices=sorted(REPORT_FORMATS), default='text',
+                        help='report format (default: text)')
+    parser.add_argument('--sort', action='store_true', help='report accounts by client id')
+    parser.add_argument('--output', metavar='PATH', help='write the report to PATH instead of stdout')
+    parser.add_argument('--metrics', choices=('prometheus', 'json'),
+                        help='count and time the run, and dump the metrics at the end '
+                             'and on SIGUSR1')
+    parser.add_argument('--metrics-out', metavar='PATH',
+                        help='write metrics to PATH instead of stderr')
+    args = parser.parse_args(argv[1:] if args is None else args)
+    if args.workers > 1 and (args.load_snapshot or args.save_snapshot):
+        parser.error('snapshots are not supported with --workers')
+    if args.workers > 1 and args.metrics:
+        parser.error('--metrics is not supported with --workers')
+    if args.wal and (args.workers > 1 or args.load_snapshot or args.numpy):
+        parser.error('--wal is not supported with --workers, --load-snapshot or --numpy')
+    if args.spill and (args.workers > 1 or args.wal or args.load_snapshot or args.save_snapshot):
+        parser.error('--spill is not supported with --workers, --wal or snapshots')
+    if args.pipeline and (args.workers > 1 or args.wal or args.numpy):
+        parser.error('--pipeline is not supported with --workers, --wal or --numpy')
+    if args.numpy and (args.workers > 1 or args.kernel):
+        parser.error('--numpy is not supported with --workers or --kernel')
+    if args.kernel and args.workers > 1:
+        parser.error('--kernel is not supported with --workers')
+    if args.query_socket and (args.workers > 1 or args.wal or args.pipeline):
+        parser.error('--query-socket is not supported with --workers, --wal or --pipeline')
+    if args.numpy or args.kernel:
+        args.fixed = True
+    if args.numpy:
+        try:
+            from engine_numpy import NumpyEngine
+        except ImportError:
+            exit('--numpy needs numpy installed')
+    if not args.input:
         exit("No input file specified")
     else:
-        input_csv = argv[1]
-        csvfile = open(input_csv, newline='')
-        has_header = Sniffer().has_header(csvfile.read(1024))
-        csvfile.close()
-        fields = ['type', 'client', 'tx', 'amount']
-        with open(input_csv, newline='') as csvfile:
-            reader = DictReader(csvfile, fieldnames=None if has_header else fields)
-            for row in reader:
-                # If tx_id already recorded, ignore deposits and withdrawals
-                if int(row['tx']) in transactions:
-                    if row['type'] in [TransactionType.DEPOSIT.value, TransactionType.WITHDRAWAL.value]:
-                        continue
-                    else:
-                        # Not adding disputes, resolves, or chargebacks to transactions
-                        transx = Transaction(row['type'], int(row['client']), int(row['tx']), 0)
-                # If tx_id NOT already recorded, can only be deposits and withdrawals
+        try:
+            inputs = expand_inputs(args.input)
+        except FileNotFoundError as e:
+            exit(str(e))
+        several = len(inputs) > 1 or args.order_by
+        if several and (args.workers > 1 or args.wal or args.pipeline or args.query_socket
+                        or '-' in inputs):
+            parser.error('several inputs or --order-by are not supported with --workers, '
+                         '--wal, --pipeline, --query-socket or stdin')
+        metrics = Metrics() if args.metrics else None
+        if metrics is not None:
+            dump = lambda *_: dump_metrics(metrics, args.metrics, sys.stderr if err is None else err,
+                                           args.metrics_out)
+            import signal
+            signal.signal(signal.SIGUSR1, dump)
+        # Closes what the run opens along the way, such as the --spill store
+        with ExitStack() as cleanup, nullcontext() if several else open_input(inputs[0]) as csvfile:
+            if args.workers > 1:
+                report = run_sharded(read_rows(csvfile), args.workers, args.fixed)
+            else:
+                rows = None if several else read_rows(csvfile)
+                durable = None
+                if args.wal:
+                    from engine_wal import DurableEngine
+                    try:
+                        durable = DurableEngine(args.wal, args.fixed, args.sync_every,
+                                                args.compact_every)
+                    except ValueError as e:
+                        exit(str(e))
+                    engine = durable.engine
+                    if args.resume:
+                        rows = islice(rows, durable.rows, None)
+                elif args.load_snapshot:
+                    engine = read_snapshot(args.load_snapshot)
+                    if args.fixed and not engine.fixed:
+                        exit(f'{args.load_snapshot} was not saved with --fixed')
+                elif args.spill:
+                    from engine_store import SpillStore
+                    try:
+                        store = cleanup.enter_context(SpillStore(args.spill, args.fixed,
+                                                                 args.cache_size,
+                                                                 args.overwrite_spill))
+                    except FileExistsError:
+                        exit(f'{args.spill} exists; pass --overwrite-spill to replace it')
+                    engine = Engine(args.fixed, transactions=store)
+                    if metrics is not None:
+                        for name in ('hits', 'misses', 'hit_rate', 'spilled'):
+                            metrics.gauges[f'tx_cache_{name}'] = \
+                                lambda name=name: store.stats()[name] or 0
+                else:
+                    engine = Engine(args.fixed)
+                if args.numpy or args.kernel:
+                    fast = (NumpyEngine if args.numpy else KernelEngine)(engine.accounts,
+                                                                       engine.transactions)
+                    fast.disputes, fast.total_held = engine.disputes, engine.total_held
+                    engine = fast
+                engine.metrics = metrics
+                if durable is not None:
+                    durable.engine = engine
+                    with durable:
+                        durable.apply_batch(rows)
+                elif several:
+                    run_files(inputs, engine, args.jobs, args.order_by)
+                elif args.pipeline:
+                    times = run_pipelined(rows, engine, args.pipeline == 'process')
+                    if metrics is not None:
+                        # Named apart from the per-row stages the engine times
+                        for name, seconds in times.items():
+                            metrics.stages[f'pipeline_{name}'] += seconds
+                elif args.query_socket:
+                    from engine_view import LedgerView, serve_queries
+                    view = LedgerView(engine)
+                    try:
+                        server = serve_queries(view, args.query_socket)
+                    except FileExistsError as e:
+                        exit(str(e))
+                    try:
+                        view.apply_batch(rows)
+                    finally:
+                        server.shutdown()
+                        server.server_close()
                 else:
-                    if row['type'] not in [TransactionType.DEPOSIT.value, TransactionType.WITHDRAWAL.value]:
-                        continue
-                    else:
-                        # These need to be added to the transactions
-                        transx = Transaction(row['type'], int(row['client']), int(row['tx']), Decimal(row['amount']))
-                        transactions[int(row['tx'])] = transx
-        print('client,available,held,total,locked')
-        for acct in accounts:
-            print(accounts[acct])
+                    engine.apply_batch(rows)
+                if args.save_snapshot:
+                    write_snapshot(engine, args.save_snapshot)
+                report = engine.accounts.values()
+        with metrics.stage('output') if metrics is not None else nullcontext():
+            if args.output is None:
+                if out is None:
+                    sys.stdout.flush()
+                write_report(report, sys.stdout.buffer if out is None else out, args.format,
+                             args.sort)
+            else:
+                with open(args.output, 'wb', buffering=1 << 20) as out:
+                    write_report(report, out, args.format, args.sort)
+        if metrics is not None:
+            dump()
+
+def dump_metrics(metrics: Metrics, fmt: str, stream, path: str=None):
+    text = metrics.to_prometheus() if fmt == 'prometheus' else metrics.to_json() + '\n'
+    if path is None:
+        stream.write(text)
+        stream.flush()
+    else:
+        with open(path, 'w') as out:
+            out.write(text)
             
 if __name__ == "__main__":
     main()            
\ No newline at end of file
@@ -1,4 +1,4 @@
-import pytest, os, sys, importlib
+import pytest, os, sys, importlib, io, gzip
 from decimal import Decimal, getcontext
 
 getcontext().prec = 4
@@ -350,4 +350,612 @@ def test_transaction_chargeback_already_resolved():
                                 client_id=99, tx_id=44)
     assert engine.accounts[99].total == Decimal('11.22')    
     assert engine.accounts[99].available == Decimal('11.22')
-    assert engine.accounts[99].held == Decimal('0')    
\ No newline at end of file
+    assert engine.accounts[99].held == Decimal('0')    
+
+def test_process_row_ignores_unknown_types():
+    engine.accounts = {}
+    engine.transactions = engine.TransactionStore()
+    for row in (('deposit', 1, 1, '5.0'), ('refund', 2, 1, ''), ('Dispute', 1, 1, '')):
+        engine.process_row(*row)
+    assert [str(acct) for acct in engine.accounts.values()] == ['1, 5.0, 0, 5.0, False']
+
+def test_read_rows_header_and_noheader_match():
+    with engine.open_input(os.path.join(basepath, 'header.csv')) as f:
+        with_header = list(engine.read_rows(f))
+    with engine.open_input(os.path.join(basepath, 'noheader.csv')) as f:
+        without_header = list(engine.read_rows(f))
+    assert with_header == without_header
+    assert with_header[0] == ('deposit', '1', '1', '1.0')
+    assert with_header[6] == ('dispute', '3', '6', '')
+
+def test_read_rows_whitespace_and_column_order():
+    lines = io.StringIO('client, tx, type, amount\n1, 7, deposit, 2.5\n1, 7, dispute\n\n')
+    assert list(engine.read_rows(lines)) == [('deposit', '1', '7', '2.5'),
+                                             ('dispute', '1', '7', '')]
+
+def test_read_rows_first_line_is_a_header_only_if_it_names_every_field():
+    lines = io.StringIO('refund,1,1,1.0\ndeposit,1,2,2.0\n')
+    assert list(engine.read_rows(lines)) == [('refund', '1', '1', '1.0'),
+                                             ('deposit', '1', '2', '2.0')]
+    lines = io.StringIO('type,client,amount\ndeposit,1,2,2.0\n')
+    assert list(engine.read_rows(lines))[1] == ('deposit', '1', '2', '2.0')
+
+def test_open_input_gzip(tmp_path):
+    path = tmp_path / 'input.csv.gz'
+    with open(os.path.join(basepath, 'header.csv'), 'rb') as f:
+        path.write_bytes(gzip.compress(f.read()))
+    with engine.open_input(str(path)) as f:
+        assert next(engine.read_rows(f)) == ('deposit', '1', '1', '1.0')
+
+def test_main(monkeypatch, capsys):
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', os.path.join(basepath, 'header.csv')])
+    engine.main()
+    assert capsys.readouterr().out == 'client,available,held,total,locked\n' \
+                                      '1, 4.0, 0, 4.0, False\n' \
+                                      '2, 8.0, 0, 8.0, False\n' \
+                                      '3, 0.0, 10.0, 10.0, False\n' \
+                                      '4, 0.0, 0.0, 0.0, True\n'
+
+def test_parse_amount():
+    assert engine.parse_amount('11.22') == 112200
+    assert engine.parse_amount('3') == 30000
+    assert engine.parse_amount('.5') == 5000
+    assert engine.parse_amount('-1.25') == -12500
+    assert engine.parse_amount('0.00005') == 0
+    assert engine.parse_amount('0.00015') == 2
+    assert engine.parse_amount('0.000051') == 1
+
+def test_format_amount():
+    assert engine.format_amount(112200) == '11.2200'
+    assert engine.format_amount(0) == '0.0000'
+    assert engine.format_amount(-5) == '-0.0005'
+
+def test_fixed_account():
+    acct = engine.FixedAccount(client_id=99)
+    assert str(acct) == '99, 0.0000, 0.0000, 0.0000, False'
+    acct.total = 112200
+    assert acct.total == 112200
+
+def test_fixed_transaction_large_balance():
+    for tx_id in (1, 2):
+        engine.transactions[tx_id] = engine.FixedTransaction(
+            _type=engine.TransactionType.DEPOSIT.value, client_id=99, tx_id=tx_id,
+            amount=engine.parse_amount('123456789.1234'))
+    engine.FixedTransaction(_type=engine.TransactionType.DISPUTE.value, client_id=99, tx_id=2)
+    assert str(engine.accounts[99]) == '99, 123456789.1234, 123456789.1234, 246913578.2468, False'
+
+def test_main_fixed(monkeypatch, capsys):
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--fixed',
+                                         os.path.join(basepath, 'noheader.csv')])
+    engine.main()
+    assert capsys.readouterr().out.splitlines()[1:] == ['1, 4.0000, 0.0000, 4.0000, False',
+                                                        '2, 8.0000, 0.0000, 8.0000, False',
+                                                        '3, 0.0000, 10.0000, 10.0000, False',
+                                                        '4, 0.0000, 0.0000, 0.0000, True']
+
+def test_account_is_slotted():
+    acct = engine.Account(client_id=99)
+    with pytest.raises(AttributeError):
+        acct.balance = Decimal('1')
+
+def test_transaction_store():
+    store = engine.TransactionStore()
+    assert 44 not in store
+    assert store.get(44) is None
+    store[44] = engine.Transaction(_type=engine.TransactionType.DEPOSIT.value,
+                                   client_id=99, tx_id=44, amount=Decimal('11.22'))
+    store[2**32 - 1] = engine.Transaction(_type=engine.TransactionType.WITHDRAWAL.value,
+                                          client_id=7, tx_id=2**32 - 1, amount=Decimal('1'))
+    assert 44 in store and 45 not in store
+    assert len(store) == 2
+    assert store[44].tx_type == 'deposit'
+    assert store[44].client_id == 99
+    assert store[44].amount == Decimal('11.22')
+    assert store[2**32 - 1].tx_type == 'withdrawal'
+    with pytest.raises(KeyError):
+        store[45]
+    with pytest.raises(ValueError):
+        store[2**32] = store[44]
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_transaction_store_scattered_ids_stay_small(fixed):
+    import random, tracemalloc
+    tx_ids = random.Random(0).sample(range(2**32), 2000)
+    amount = 15000 if fixed else Decimal('1.5')
+    tracemalloc.start()
+    store = engine.TransactionStore(fixed)
+    for tx_id in tx_ids:
+        store.add(tx_id, 'deposit', 1, amount)
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert all(tx_id in store for tx_id in tx_ids)
+    assert used < 16 * 2**20
+
+def test_transaction_store_failed_add_leaves_no_trace():
+    store = engine.TransactionStore(fixed=True)
+    for client_id, amount in ((1, 10**20 * engine.SCALE), (2**32, 15000), (-1, 15000)):
+        with pytest.raises(OverflowError):
+            store.add(7, 'deposit', client_id, amount)
+        assert 7 not in store and len(store) == 0
+    ledger = engine.Engine(True)
+    with pytest.raises(OverflowError):
+        ledger.apply_batch([('deposit', '1', '1', '1e20')])
+    ledger.apply_batch([('deposit', '1', '1', '5')])
+    assert str(ledger.accounts[1]) == '1, 5.0000, 0.0000, 5.0000, False'
+
+def test_transaction_store_fixed_dispute():
+    engine.transactions = engine.TransactionStore(fixed=True)
+    engine.process_row('deposit', 99, 44, '11.22', engine.FixedTransaction)
+    engine.process_row('dispute', 99, 44, '', engine.FixedTransaction)
+    assert engine.transactions[44].amount == 112200
+    assert str(engine.accounts[99]) == '99, 0.0000, 11.2200, 11.2200, False'
+
+def test_tx_id_set():
+    seen = engine.TxIdSet()
+    seen.add(7)
+    seen.add(2**32 - 1)
+    assert 7 in seen and 2**32 - 1 in seen
+    assert 6 not in seen and 8 not in seen and 2**20 not in seen
+
+def random_rows(count, seed=0):
+    import random
+    rng = random.Random(seed)
+    types = [t.value for t in engine.TransactionType]
+    return [(rng.choice(types), str(rng.randint(1, 20)), str(rng.randint(1, count // 2)),
+             str(rng.randint(1, 5000) / 100)) for _ in range(count)]
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_run_sharded_matches_single_process(fixed):
+    rows = random_rows(3000)
+    # Unknown types, one of them for a known tx of a client not seen before
+    known = next(tx for _type, _, tx, _ in rows if _type in engine.RECORDED)
+    rows[1000:1000] = [('Dispute', '21', known, ''), ('refund', '1', known, '1.0')]
+    ledger = engine.Engine(fixed)
+    ledger.apply_batch(rows)
+    expected = [str(acct) for acct in ledger.accounts.values()]
+    assert not any(line.startswith('21,') for line in expected)
+    assert [str(acct) for acct in engine.run_sharded(iter(rows), 3, fixed)] == expected
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_run_sharded_raises_a_worker_error(fixed):
+    # Enough rows after the bad one to fill the failed worker's pipe
+    rows = random_rows(40000)
+    rows[10:10] = [('deposit', '2', '999999', 'bad')]
+    with pytest.raises((ValueError, ArithmeticError)) as raised:
+        engine.run_sharded(iter(rows), 2, fixed)
+    assert not isinstance(raised.value, ConnectionError)
+    if fixed:
+        assert 'bad' in str(raised.value)
+
+def test_engine_owns_its_state():
+    first, second = engine.Engine(), engine.Engine(fixed=True)
+    first.apply(('deposit', '99', '44', '11.22'))
+    second.apply_batch([('deposit', '99', '44', '1.5'), ('dispute', '99', '44', '')])
+    assert str(first.accounts[99]) == '99, 11.22, 0, 11.22, False'
+    assert str(second.accounts[99]) == '99, 0.0000, 1.5000, 1.5000, False'
+    assert 99 not in engine.accounts and 44 not in engine.transactions
+
+def test_engine_ignores_unknown_rows():
+    ledger = engine.Engine()
+    ledger.apply_batch([('dispute', '99', '44', ''), ('refund', '99', '45', '1.0')])
+    assert ledger.accounts == {}
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_engine_matches_process_row(fixed):
+    rows = random_rows(3000, seed=1)
+    tx_class = engine.FixedTransaction if fixed else engine.Transaction
+    engine.transactions = engine.TransactionStore(fixed=fixed)
+    for _type, client, tx, amount in rows:
+        engine.process_row(_type, int(client), int(tx), amount, tx_class)
+    ledger = engine.Engine(fixed)
+    ledger.apply_batch(rows)
+    assert [str(acct) for acct in ledger.accounts.values()] == \
+           [str(acct) for acct in engine.accounts.values()]
+
+def test_duplicate_dispute_holds_once():
+    ledger = engine.Engine(fixed=True)
+    ledger.apply_batch([('deposit', '1', '1', '10'), ('dispute', '1', '1', ''),
+                        ('dispute', '1', '1', '')])
+    assert str(ledger.accounts[1]) == '1, 0.0000, 10.0000, 10.0000, False'
+    assert ledger.dispute(1, 1) == engine.REJECT_ALREADY_DISPUTED
+
+def test_resolve_needs_that_tx_disputed():
+    ledger = engine.Engine(fixed=True)
+    ledger.apply_batch([('deposit', '1', '1', '10'), ('deposit', '1', '2', '5'),
+                        ('dispute', '1', '1', '')])
+    assert ledger.resolve(1, 2) == engine.REJECT_NOT_DISPUTED
+    assert ledger.chargeback(1, 2) == engine.REJECT_NOT_DISPUTED
+    assert str(ledger.accounts[1]) == '1, 5.0000, 10.0000, 15.0000, False'
+    assert ledger.resolve(1, 1) is None
+    assert str(ledger.accounts[1]) == '1, 15.0000, 0.0000, 15.0000, False'
+
+def test_dispute_states():
+    ledger = engine.Engine()
+    ledger.apply_batch([('deposit', '1', '1', '10'), ('deposit', '1', '2', '5')])
+    assert ledger.state(1) == engine.NORMAL
+    ledger.dispute(1, 1)
+    assert ledger.state(1) == engine.DISPUTED
+    ledger.resolve(1, 1)
+    assert ledger.state(1) == engine.RESOLVED
+    # A resolved deposit can be disputed again
+    assert ledger.dispute(1, 1) is None
+    ledger.chargeback(1, 1)
+    assert ledger.state(1) == engine.CHARGEDBACK
+    ledger.accounts[1].locked = False
+    assert ledger.dispute(1, 1) == engine.REJECT_CHARGEDBACK
+    assert ledger.state(2) == engine.NORMAL
+    assert ledger.transactions[1].tx_type == 'deposit'
+
+def test_legacy_duplicate_dispute_holds_once():
+    engine.process_row('deposit', 99, 44, '11.22')
+    engine.process_row('dispute', 99, 44, '')
+    engine.process_row('dispute', 99, 44, '')
+    assert engine.accounts[99].held == Decimal('11.22')
+    assert engine.accounts[99].available == Decimal('0')
+
+def test_open_disputes_index():
+    ledger = engine.Engine(fixed=True)
+    ledger.apply_batch([('deposit', '1', '1', '10'), ('deposit', '1', '2', '5'),
+                        ('deposit', '2', '3', '1'), ('dispute', '1', '1', ''),
+                        ('dispute', '1', '2', ''), ('dispute', '2', '3', ''),
+                        ('resolve', '1', '1', '')])
+    assert ledger.open_disputes(1) == [(1, 2, 50000)]
+    assert sorted(ledger.open_disputes()) == [(1, 2, 50000), (2, 3, 10000)]
+    assert ledger.open_disputes(3) == []
+    assert ledger.total_held == 60000
+    ledger.apply_batch([('chargeback', '2', '3', '')])
+    assert ledger.disputes == {1: {2: 50000}}
+    assert ledger.total_held == sum(acct.held for acct in ledger.accounts.values())
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_snapshot_keeps_dispute_states(tmp_path, fixed):
+    ledger = engine.Engine(fixed)
+    ledger.apply_batch([('deposit', '1', '1', '10'), ('deposit', '1', '2', '5'),
+                        ('dispute', '1', '1', ''), ('dispute', '1', '2', ''),
+                        ('resolve', '1', '2', '')])
+    engine.write_snapshot(ledger, str(tmp_path / 'state.snap'))
+    resumed = engine.read_snapshot(str(tmp_path / 'state.snap'))
+    assert resumed.disputes == ledger.disputes
+    assert resumed.total_held == ledger.total_held
+    assert (resumed.state(1), resumed.state(2)) == (engine.DISPUTED, engine.RESOLVED)
+    assert resumed.dispute(1, 1) == engine.REJECT_ALREADY_DISPUTED
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_snapshot_then_delta_matches_full_run(tmp_path, fixed):
+    rows = random_rows(3000, seed=2)
+    full = engine.Engine(fixed)
+    full.apply_batch(rows)
+    first = engine.Engine(fixed)
+    first.apply_batch(rows[:2000])
+    engine.write_snapshot(first, str(tmp_path / 'state.snap'))
+    resumed = engine.read_snapshot(str(tmp_path / 'state.snap'))
+    assert resumed.fixed == fixed
+    assert len(resumed.transactions) == len(first.transactions)
+    resumed.apply_batch(rows[2000:])
+    assert [str(acct) for acct in resumed.accounts.values()] == \
+           [str(acct) for acct in full.accounts.values()]
+
+def test_snapshot_of_empty_engine(tmp_path):
+    engine.write_snapshot(engine.Engine(), str(tmp_path / 'empty.snap'))
+    assert engine.read_snapshot(str(tmp_path / 'empty.snap')).accounts == {}
+
+def test_read_snapshot_rejects_other_files():
+    with pytest.raises(ValueError):
+        engine.read_snapshot(os.path.join(basepath, 'header.csv'))
+
+def test_metrics_count_rows_and_rejections():
+    ledger = engine.Engine()
+    ledger.metrics = engine.Metrics(sample_every=1)
+    ledger.apply_batch([('deposit', '1', '1', '10.0'),
+                        ('deposit', '1', '1', '10.0'),
+                        ('withdrawal', '1', '2', '50.0'),
+                        ('dispute', '1', '9', ''),
+                        ('deposit', '2', '3', '5.0'),
+                        ('dispute', '1', '3', ''),
+                        ('resolve', '1', '1', ''),
+                        ('dispute', '1', '1', ''),
+                        ('chargeback', '1', '1', ''),
+                        ('deposit', '1', '4', '1.0')])
+    metrics = ledger.metrics
+    assert metrics.rows == {'deposit': 4, 'withdrawal': 1, 'dispute': 3, 'resolve': 1, 'chargeback': 1}
+    assert metrics.rejected == {'duplicate_tx': 1, 'overdraw': 1, 'unknown_tx': 1,
+                                'cross_client_dispute': 1, 'not_disputed': 1, 'locked_account': 1}
+    assert set(metrics.stages) == {'read', 'amount', 'store', 'apply'}
+    assert sum(metrics.latency['deposit'][:-1]) == 3
+    assert str(ledger.accounts[1]) == '1, 0.0, 0.0, 0.0, True'
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_metrics_from_apply_chunk_match_apply_batch(fixed):
+    rows = random_rows(2000)
+    counted = []
+    for apply in (lambda ledger: ledger.apply_batch(rows),
+                  lambda ledger: ledger.apply_chunk(engine.parse_chunk(rows, fixed))):
+        ledger = engine.Engine(fixed)
+        ledger.metrics = engine.Metrics(sample_every=1)
+        apply(ledger)
+        metrics = ledger.metrics
+        counted.append((metrics.rows, metrics.rejected,
+                        {_type: sum(histogram[:-1]) for _type, histogram in metrics.latency.items()}))
+    assert counted[0] == counted[1]
+
+def test_metrics_to_prometheus():
+    metrics = engine.Metrics()
+    metrics.rows['deposit'] += 2
+    metrics.rejected['overdraw'] += 1
+    metrics.observe('deposit', 3e-6)
+    text = metrics.to_prometheus()
+    assert 'payment_engine_rows_total{type="deposit"} 2\n' in text
+    assert 'payment_engine_rejected_total{reason="overdraw"} 1\n' in text
+    assert 'payment_engine_row_latency_seconds_bucket{type="deposit",le="2.5e-06"} 0\n' in text
+    assert 'payment_engine_row_latency_seconds_bucket{type="deposit",le="5e-06"} 1\n' in text
+    assert 'payment_engine_row_latency_seconds_bucket{type="deposit",le="+Inf"} 1\n' in text
+    assert 'payment_engine_row_latency_seconds_count{type="deposit"} 1\n' in text
+
+def test_metrics_fold_unknown_types_and_escape_labels():
+    ledger = engine.Engine()
+    ledger.metrics = engine.Metrics(sample_every=1)
+    ledger.apply_batch([('deposit', '1', '1', '1.0'), ('refund', '1', '1', ''),
+                        ('x"} 1\nevil 2', '1', '1', ''), ('Deposit', '1', '2', '1.0')])
+    assert ledger.metrics.rows == {'deposit': 1, 'other': 3}
+    assert ledger.metrics.rejected == {}
+    assert set(ledger.metrics.latency) == {'deposit'}
+    metrics = engine.Metrics()
+    metrics.stages['a\\b"c\nd'] += 1
+    assert 'payment_engine_stage_seconds_total{stage="a\\\\b\\"c\\nd"} 1.000000\n' \
+        in metrics.to_prometheus()
+
+@pytest.mark.parametrize('flags', [[], ['--pipeline', 'thread'], ['--pipeline', 'process'],
+                                   ['--kernel']])
+def test_main_metrics(monkeypatch, capsys, tmp_path, flags):
+    out = tmp_path / 'metrics.json'
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--metrics', 'json', '--metrics-out',
+                                         str(out), *flags, os.path.join(basepath, 'header.csv')])
+    engine.main()
+    assert capsys.readouterr().out.startswith('client,available,held,total,locked\n1, 4.0')
+    import json
+    metrics = json.loads(out.read_text())
+    assert metrics['rows']['deposit'] == 7
+    assert metrics['rejected'] == {'overdraw': 1, 'locked_account': 1}
+    assert 'output' in metrics['stage_seconds']
+    if '--pipeline' in flags:
+        assert {'apply', 'pipeline_apply', 'pipeline_parse_wait'} <= set(metrics['stage_seconds'])
+
+def report_accounts(fixed):
+    ledger = engine.Engine(fixed)
+    ledger.apply_batch([('deposit', '7', '1', '12345.6789'), ('deposit', '3', '2', '1.5'),
+                        ('dispute', '3', '2', '')])
+    return ledger.accounts.values()
+
+@pytest.mark.parametrize('fmt, expected', [
+    ('text', 'client,available,held,total,locked\n3, 0.0000, 1.5000, 1.5000, False\n'
+             '7, 12345.6789, 0.0000, 12345.6789, False\n'),
+    ('csv', 'client,available,held,total,locked\n3,0.0000,1.5000,1.5000,False\n'
+            '7,12345.6789,0.0000,12345.6789,False\n'),
+    ('jsonl', '{"client": 3, "available": "0.0000", "held": "1.5000", "total": "1.5000", "locked": false}\n'
+              '{"client": 7, "available": "12345.6789", "held": "0.0000", "total": "12345.6789", "locked": false}\n'),
+])
+def test_write_report_formats(monkeypatch, fmt, expected):
+    monkeypatch.setattr(engine, 'REPORT_CHUNK', 1)
+    out = io.BytesIO()
+    engine.write_report(report_accounts(fixed=True), out, fmt, sort=True)
+    assert out.getvalue().decode() == expected
+
+def test_write_report_jsonl_decimal():
+    out = io.BytesIO()
+    engine.write_report(report_accounts(fixed=False), out, 'jsonl')
+    import json
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == [
+        {'client': 7, 'available': '1.235E+4', 'held': '0', 'total': '1.235E+4', 'locked': False},
+        {'client': 3, 'available': '0.0', 'held': '1.5', 'total': '1.5', 'locked': False}]
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_write_report_binary(fixed):
+    out = io.BytesIO()
+    engine.write_report(report_accounts(fixed), out, 'binary')
+    out.seek(0)
+    big = 123456789 if fixed else 123500000
+    assert list(engine.read_binary_report(out)) == [(7, big, 0, big, False),
+                                                    (3, 0, 15000, 15000, False)]
+
+def test_read_binary_report_streams_records(monkeypatch):
+    monkeypatch.setattr(engine, 'REPORT_CHUNK', 3)
+    accts = [engine.FixedAccount(client) for client in range(10)]
+    out = io.BytesIO()
+    engine.write_report(accts, out, 'binary')
+    # A stream that returns fewer bytes than asked for, like a pipe
+    class Trickle(io.BytesIO):
+        def read(self, size=-1):
+            return super().read(min(size, 50) if size > 0 else size)
+    data = out.getvalue()
+    records = list(engine.read_binary_report(Trickle(data)))
+    assert [record[0] for record in records] == list(range(10))
+    with pytest.raises(ValueError, match='partial record'):
+        list(engine.read_binary_report(io.BytesIO(data[:-1])))
+
+def test_parse_chunk():
+    codes, clients, txs, amounts = engine.parse_chunk(
+        [('deposit', '1', '2', '1.5'), ('refund', '1', '3', '1'), ('dispute', '1', '2', '')],
+        fixed=True)
+    assert list(codes) == [0, 2]
+    assert (list(clients), list(txs), list(amounts)) == ([1, 1], [2, 2], [15000, 0])
+    assert engine.parse_chunk([('withdrawal', '1', '2', '1.5')])[3] == [Decimal('1.5')]
+
+@pytest.mark.parametrize('process', [False, True])
+@pytest.mark.parametrize('fixed', [False, True])
+def test_run_pipelined_matches_apply_batch(fixed, process):
+    rows = random_rows(3000)
+    expected = engine.Engine(fixed)
+    expected.apply_batch(rows)
+    ledger = engine.Engine(fixed)
+    times = engine.run_pipelined(iter(rows), ledger, process, chunk_size=100, queue_size=2)
+    assert [str(acct) for acct in ledger.accounts.values()] == \
+           [str(acct) for acct in expected.accounts.values()]
+    assert set(times) == {'parse', 'parse_wait', 'apply', 'apply_wait'}
+
+@pytest.mark.parametrize('process', [False, True])
+def test_run_pipelined_counts_dropped_rows_in_metrics(process):
+    rows = random_rows(500)
+    rows[100:100] = [('refund', '1', '1', '1.0'), ('Deposit', '2', '999', '1.0')]
+    counted = []
+    for pipelined in (False, True):
+        ledger = engine.Engine(True)
+        ledger.metrics = engine.Metrics()
+        if pipelined:
+            engine.run_pipelined(iter(rows), ledger, process, chunk_size=100)
+        else:
+            ledger.apply_batch(rows)
+        counted.append((ledger.metrics.rows, ledger.metrics.rejected))
+    assert counted[0] == counted[1] and counted[0][0]['other'] == 2
+
+def test_run_pipelined_leaves_bad_rows_to_apply_batch():
+    # The duplicate's amount is never parsed, so it is not an error
+    ledger = engine.Engine(fixed=True)
+    engine.run_pipelined([('deposit', '1', '1', '1'), ('deposit', '1', '1', 'x')], ledger)
+    assert str(ledger.accounts[1]) == '1, 1.0000, 0.0000, 1.0000, False'
+    with pytest.raises(ValueError):
+        engine.run_pipelined([('deposit', '1', '2', 'x')], engine.Engine(fixed=True))
+    with pytest.raises(ValueError):
+        engine.run_pipelined([('deposit', '1', 'x', '1')], engine.Engine(fixed=True))
+
+@pytest.mark.parametrize('mode', ['thread', 'process'])
+def test_main_pipeline(monkeypatch, capsys, mode):
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--fixed', '--pipeline', mode,
+                                         os.path.join(basepath, 'noheader.csv')])
+    engine.main()
+    assert capsys.readouterr().out.splitlines()[1:] == ['1, 4.0000, 0.0000, 4.0000, False',
+                                                        '2, 8.0000, 0.0000, 8.0000, False',
+                                                        '3, 0.0000, 10.0000, 10.0000, False',
+                                                        '4, 0.0000, 0.0000, 0.0000, True']
+
+def write_inputs(tmp_path, parts, header=True):
+    paths = []
+    for i, rows in enumerate(parts):
+        path = tmp_path / f'part{i:02d}.csv'
+        lines = ['type,client,tx,amount\n'] if header and i % 2 else []
+        path.write_text(''.join(lines) + ''.join(f'{",".join(row)}\n' for row in rows))
+        paths.append(str(path))
+    return paths
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_run_files_matches_concatenation(tmp_path, fixed):
+    rows = random_rows(3000, seed=3)
+    parts = [rows[i:i + 400] for i in range(0, len(rows), 400)]
+    paths = write_inputs(tmp_path, parts)
+    with open(paths[0], 'rb') as f, gzip.open(paths[0] + '.gz', 'wb') as out:
+        out.write(f.read())
+    paths[0] += '.gz'
+    expected = engine.Engine(fixed)
+    expected.apply_batch(rows)
+    ledger = engine.Engine(fixed)
+    engine.run_files(paths, ledger, jobs=2)
+    assert [str(acct) for acct in ledger.accounts.values()] == \
+           [str(acct) for acct in expected.accounts.values()]
+
+def test_run_files_applies_unparsable_files_like_apply_batch(tmp_path):
+    paths = write_inputs(tmp_path, [[('deposit', '1', '1', '1')],
+                                    [('deposit', '1', '1', 'x'), ('deposit', '1', '2', '2')]])
+    ledger = engine.Engine(fixed=True)
+    engine.run_files(paths, ledger, jobs=2)
+    assert str(ledger.accounts[1]) == '1, 3.0000, 0.0000, 3.0000, False'
+
+def test_run_files_order_by(tmp_path):
+    first = tmp_path / 'a.csv'
+    first.write_text('seq,type,client,tx,amount\n1,deposit,1,1,5\n4,withdrawal,1,3,6\n'
+                     '5,dispute,1,1,\n')
+    second = tmp_path / 'b.csv'
+    second.write_text('type,client,tx,amount,seq\ndeposit,1,2,2,3\nwithdrawal,1,4,1,4\n'
+                      'deposit,1,5,1,2\n')
+    ledger = engine.Engine(fixed=True)
+    engine.run_files([str(first), str(second)], ledger, jobs=2, order_by='seq')
+    expected = engine.Engine(fixed=True)
+    # By seq, ties in file order, and each file sorted by seq
+    expected.apply_batch([('deposit', '1', '1', '5'), ('deposit', '1', '5', '1'),
+                          ('deposit', '1', '2', '2'), ('withdrawal', '1', '3', '6'),
+                          ('withdrawal', '1', '4', '1'), ('dispute', '1', '1', '')])
+    assert str(ledger.accounts[1]) == str(expected.accounts[1])
+    assert str(ledger.accounts[1]) == '1, -4.0000, 5.0000, 1.0000, False'
+    with pytest.raises(ValueError):
+        engine.run_files([str(first)], engine.Engine(), order_by='timestamp')
+
+def test_read_sequenced_rows_keys():
+    lines = io.StringIO('type,client,tx,amount,ts\ndeposit,1,1,1,2024-01-02T00:00\n\n'
+                        'deposit,1,2,1,2024-01-01T00:00\ndispute,1,1,,2024-01-03\n')
+    assert list(engine.read_sequenced_rows(lines, 'ts')) == [
+        ('2024-01-02T00:00', ('deposit', '1', '1', '1')),
+        ('2024-01-01T00:00', ('deposit', '1', '2', '1')),
+        ('2024-01-03', ('dispute', '1', '1', ''))]
+
+@pytest.mark.parametrize('cells, error', [
+    (['1', ''], 'line 3: blank seq'),
+    (['1', 'x'], "line 3: seq 'x' is not a number key"),
+    (['x', '2.5'], "line 3: seq '2.5' is not a text key"),
+])
+def test_read_sequenced_rows_rejects_bad_keys(cells, error):
+    lines = io.StringIO('type,client,tx,amount,seq\n' +
+                        ''.join(f'deposit,1,{tx},1,{cell}\n' for tx, cell in enumerate(cells)))
+    with pytest.raises(ValueError, match=error):
+        list(engine.read_sequenced_rows(lines, 'seq'))
+
+def test_read_sequenced_rows_needs_every_field():
+    with pytest.raises(ValueError, match='no tx column in the header'):
+        list(engine.read_sequenced_rows(io.StringIO('type,client,amount,seq\n'), 'seq'))
+
+def test_run_files_order_by_rejects_bad_keys(tmp_path):
+    blank = tmp_path / 'blank.csv'
+    blank.write_text('seq,type,client,tx,amount\n1,deposit,1,1,5\n,dispute,1,1,\n')
+    with pytest.raises(ValueError, match='blank.csv: line 3: blank seq'):
+        engine.run_files([str(blank)], engine.Engine(), jobs=1, order_by='seq')
+    numbers = tmp_path / 'numbers.csv'
+    numbers.write_text('seq,type,client,tx,amount\n1,deposit,1,1,5\n')
+    text = tmp_path / 'text.csv'
+    text.write_text('seq,type,client,tx,amount\na,deposit,1,2,5\n')
+    with pytest.raises(ValueError, match='number and others text seq keys'):
+        engine.run_files([str(numbers), str(text)], engine.Engine(), jobs=1, order_by='seq')
+
+def test_run_files_order_by_spans_frames(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, 'PIPELINE_CHUNK', 7)
+    rows = random_rows(500)
+    paths = []
+    for part in range(3):
+        paths.append(tmp_path / f'{part}.csv')
+        paths[-1].write_text('type,client,tx,amount,seq\n' + ''.join(
+            f'{_type},{client},{tx},{amount},{seq}\n'
+            for seq, (_type, client, tx, amount) in enumerate(rows) if seq % 3 == part))
+    ledger = engine.Engine(fixed=True)
+    engine.run_files([str(path) for path in paths], ledger, jobs=2, order_by='seq')
+    expected = engine.Engine(fixed=True)
+    expected.apply_batch(rows)
+    assert [str(acct) for acct in ledger.accounts.values()] == \
+           [str(acct) for acct in expected.accounts.values()]
+
+def test_expand_inputs(tmp_path):
+    paths = write_inputs(tmp_path, [[('deposit', '1', '1', '1')]] * 3)
+    (tmp_path / 'notes.txt').write_text('')
+    assert engine.expand_inputs([str(tmp_path)]) == paths
+    assert engine.expand_inputs([str(tmp_path / 'part0[12].csv'), paths[0], '-']) == \
+           paths[1:] + paths[:1] + ['-']
+    with pytest.raises(FileNotFoundError):
+        engine.expand_inputs([str(tmp_path / '*.tsv')])
+
+def test_main_several_inputs(tmp_path, monkeypatch, capsys):
+    with open(os.path.join(basepath, 'noheader.csv')) as f:
+        lines = f.readlines()
+    for i in range(0, len(lines), 4):
+        (tmp_path / f'{i:02d}.csv').write_text(''.join(lines[i:i + 4]))
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--fixed', '--jobs', '2',
+                                         str(tmp_path / '*.csv')])
+    engine.main()
+    assert capsys.readouterr().out.splitlines()[1:] == ['1, 4.0000, 0.0000, 4.0000, False',
+                                                        '2, 8.0000, 0.0000, 8.0000, False',
+                                                        '3, 0.0000, 10.0000, 10.0000, False',
+                                                        '4, 0.0000, 0.0000, 0.0000, True']
+
+def test_import_defers_optional_modules():
+    import subprocess
+    code = 'import sys, payment_engine; print(" ".join(sorted(set(sys.modules) & ' \
+           '{"argparse", "enum", "glob", "gzip", "json", "mmap", "signal"})))'
+    out = subprocess.run([sys.executable, '-c', code], cwd=basepath, capture_output=True,
+                         text=True, check=True).stdout
+    assert out.strip() == ''
+    assert [t.value for t in engine.TransactionType] == list(engine.TYPE_CODES)
+    assert engine.TransactionType('dispute') is engine.TransactionType.DISPUTE
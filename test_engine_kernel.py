@@ -0,0 +1,117 @@
+import pytest, os, sys, importlib.util
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, basepath)
+import payment_engine as engine
+import engine_kernel
+from test_engine import random_rows
+
+def load_python_kernel():
+    """engine_kernel from its source, even where a compiled build shadows it."""
+    spec = importlib.util.spec_from_file_location(
+        'engine_kernel', os.path.join(basepath, 'engine_kernel.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(params=['python', 'compiled'])
+def backend(request, monkeypatch):
+    if request.param == 'compiled':
+        if not engine_kernel.COMPILED:
+            pytest.skip('engine_kernel is not compiled; build it with mypyc')
+        module = engine_kernel
+    else:
+        module = load_python_kernel()
+        assert not module.COMPILED
+    monkeypatch.setitem(sys.modules, 'engine_kernel', module)
+    return module
+
+def report(ledger):
+    return [str(acct) for acct in ledger.accounts.values()]
+
+def assert_same(rows):
+    expected = engine.Engine(fixed=True)
+    expected.apply_batch(rows)
+    ledger = engine.KernelEngine()
+    ledger.apply_batch(rows)
+    assert report(ledger) == report(expected)
+    assert len(ledger.transactions) == len(expected.transactions)
+    assert ledger.disputes == expected.disputes
+    assert ledger.total_held == expected.total_held
+    return ledger
+
+def test_readme_example(backend):
+    with engine.open_input(os.path.join(basepath, 'header.csv')) as f:
+        ledger = assert_same(list(engine.read_rows(f)))
+    assert report(ledger) == ['1, 4.0000, 0.0000, 4.0000, False',
+                              '2, 8.0000, 0.0000, 8.0000, False',
+                              '3, 0.0000, 10.0000, 10.0000, False',
+                              '4, 0.0000, 0.0000, 0.0000, True']
+
+@pytest.mark.parametrize('seed', range(3))
+def test_random_rows(backend, seed):
+    assert_same(random_rows(3000, seed))
+
+def test_deposit_withdrawal(backend):
+    ledger = assert_same([('deposit', '1', '1', '11.22'), ('withdrawal', '1', '2', '20'),
+                          ('withdrawal', '1', '3', '1.22'), ('deposit', '1', '1', '5')])
+    assert ledger.accounts[1].available == 100000
+
+def test_disputes(backend):
+    ledger = assert_same([('deposit', '1', '1', '10'), ('deposit', '1', '2', '5'),
+                          ('withdrawal', '1', '3', '1'),
+                          ('dispute', '1', '1', ''), ('dispute', '1', '1', ''),
+                          ('resolve', '1', '2', ''), ('dispute', '1', '3', ''),
+                          ('dispute', '2', '2', ''), ('dispute', '1', '9', ''),
+                          ('resolve', '1', '1', ''), ('dispute', '1', '1', ''),
+                          ('dispute', '1', '2', ''), ('chargeback', '1', '2', '')])
+    assert str(ledger.accounts[1]) == '1, -1.0000, 10.0000, 9.0000, True'
+    assert ledger.state(1) == engine.DISPUTED and ledger.state(2) == engine.CHARGEDBACK
+    assert list(ledger.accounts) == [1, 2]
+
+def test_locked_account_ignores_rows(backend):
+    ledger = assert_same([('deposit', '1', '1', '10'), ('dispute', '1', '1', ''),
+                          ('chargeback', '1', '1', ''), ('deposit', '1', '2', '3'),
+                          ('dispute', '1', '1', '')])
+    assert 2 in ledger.transactions and ledger.accounts[1].total == 0
+
+def test_amounts_off_the_fast_path(backend):
+    ledger = assert_same([('deposit', '1', '1', '0.00005'), ('deposit', '1', '2', '2.00015'),
+                          ('deposit', '1', '3', '123456789012.5')])
+    assert ledger.accounts[1].available == 1234567890145002
+
+def test_bad_rows_raise(backend):
+    with pytest.raises(ValueError):
+        engine.KernelEngine().apply_batch([('deposit', '1', str(1 << 32), '1')])
+    with pytest.raises(ValueError):
+        engine.KernelEngine().apply_batch([('deposit', 'x', '1', '1')])
+
+def test_apply_chunk(backend):
+    rows = random_rows(3000)
+    expected = engine.Engine(fixed=True)
+    expected.apply_batch(rows)
+    ledger = engine.KernelEngine()
+    ledger.apply_chunk(engine.parse_chunk(rows, fixed=True))
+    assert report(ledger) == report(expected)
+
+def test_snapshot_round_trip(backend, tmp_path):
+    rows = random_rows(2000)
+    first = engine.KernelEngine()
+    first.apply_batch(rows[:1000])
+    engine.write_snapshot(first, str(tmp_path / 'state.snap'))
+    loaded = engine.read_snapshot(str(tmp_path / 'state.snap'))
+    ledger = engine.KernelEngine(loaded.accounts, loaded.transactions)
+    ledger.disputes, ledger.total_held = loaded.disputes, loaded.total_held
+    ledger.apply_batch(rows[1000:])
+    expected = engine.Engine(fixed=True)
+    expected.apply_batch(rows)
+    assert report(ledger) == report(expected)
+
+def test_main_kernel(backend, monkeypatch, capsys):
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--kernel',
+                                         os.path.join(basepath, 'noheader.csv')])
+    engine.main()
+    assert capsys.readouterr().out.splitlines()[1:] == ['1, 4.0000, 0.0000, 4.0000, False',
+                                                        '2, 8.0000, 0.0000, 8.0000, False',
+                                                        '3, 0.0000, 10.0000, 10.0000, False',
+                                                        '4, 0.0000, 0.0000, 0.0000, True']
@@ -0,0 +1,104 @@
+import pytest, os
+
+np = pytest.importorskip('numpy')
+
+import payment_engine as engine
+import gen_transactions
+from engine_numpy import NumpyEngine
+from test_engine import random_rows
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+
+def report(ledger):
+    return [str(acct) for acct in ledger.accounts.values()]
+
+def assert_same(rows, chunk_size=1000):
+    expected = engine.Engine(fixed=True)
+    expected.apply_batch(rows)
+    ledger = NumpyEngine(chunk_size=chunk_size)
+    ledger.apply_batch(rows)
+    assert report(ledger) == report(expected)
+    assert len(ledger.transactions) == len(expected.transactions)
+    return ledger
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1000, 65536])
+def test_matches_engine_on_random_rows(chunk_size):
+    assert_same(random_rows(3000, seed=chunk_size), chunk_size)
+
+@pytest.mark.parametrize('seed', range(3))
+def test_matches_engine_on_generated_workload(seed):
+    rows = list(gen_transactions.generate(20000, clients=50, withdrawal=0.45, dispute=0.05,
+                                          resolve=0.02, chargeback=0.01, seed=seed))
+    assert_same(rows)
+
+def test_overdraws_are_rejected_in_order():
+    rows = [('deposit', '1', '1', '5'), ('withdrawal', '1', '2', '3'),
+            ('withdrawal', '1', '3', '3'), ('deposit', '1', '4', '1'),
+            ('withdrawal', '1', '5', '3'), ('withdrawal', '1', '6', '0.0001')]
+    ledger = assert_same(rows)
+    assert ledger.accounts[1].available == 0
+
+def test_negative_amounts_match_engine():
+    rows = [('deposit', '1', '1', '5'), ('deposit', '1', '2', '-1'), ('deposit', '1', '3', '-9')]
+    assert assert_same(rows).accounts[1].available == -50000
+    # With the balance below zero, only withdrawals are rejected, whatever their sign
+    rows += [('withdrawal', '1', '4', '-2'), ('withdrawal', '1', '5', '0'),
+             ('deposit', '1', '6', '0'), ('withdrawal', '1', '7', '-8'), ('withdrawal', '1', '8', '1')]
+    assert_same(rows)
+    many = [('deposit', '2', '10', '-1')] + [('withdrawal', '2', str(tx), '-0.5')
+                                            for tx in range(11, 60)]
+    assert_same(many)
+
+def test_many_overdraws_settle_row_by_row():
+    rows = [('deposit', '1', '1', '1')]
+    rows += [('withdrawal', '1', str(tx), '2') for tx in range(2, 100)]
+    rows += [('deposit', '1', '100', '5'), ('withdrawal', '1', '101', '6')]
+    assert assert_same(rows).accounts[1].available == 0
+
+def test_duplicates_and_unknown_disputes_are_ignored():
+    rows = [('deposit', '1', '1', '5'), ('deposit', '2', '1', '7'), ('dispute', '1', '9', ''),
+            ('withdrawal', '3', '1', '1'), ('bogus', '4', '2', '1'), ('deposit', '2', '2', '1.5')]
+    ledger = assert_same(rows)
+    assert list(ledger.accounts) == [1, 2]
+
+def test_dispute_before_deposit_in_chunk_is_ignored():
+    assert_same([('dispute', '1', '1', ''), ('deposit', '1', '1', '5'), ('dispute', '1', '1', '')])
+
+def test_locked_accounts_ignore_later_chunks():
+    rows = [('deposit', '1', '1', '5'), ('dispute', '1', '1', ''), ('chargeback', '1', '1', ''),
+            ('deposit', '1', '2', '5'), ('withdrawal', '1', '3', '1')]
+    ledger = assert_same(rows, chunk_size=3)
+    assert ledger.accounts[1].locked and ledger.accounts[1].total == 0
+    assert 2 in ledger.transactions
+
+def test_inexact_amounts_match_parse_amount():
+    rows = [('deposit', '1', '1', '0.00005'), ('deposit', '1', '2', '123456789012.5'),
+            ('deposit', '1', '3', '2.00015')]
+    assert assert_same(rows).accounts[1].available == 1234567890145002
+
+def test_bad_rows_raise_like_engine():
+    with pytest.raises(ValueError):
+        NumpyEngine().apply_batch([('deposit', '1', '1', '5'), ('deposit', 'x', '2', '1')])
+    with pytest.raises(ValueError):
+        NumpyEngine().apply_batch([('deposit', '1', str(1 << 32), '5')])
+
+def test_from_snapshot(tmp_path):
+    rows = random_rows(2000)
+    before = engine.Engine(fixed=True)
+    before.apply_batch(rows[:1000])
+    engine.write_snapshot(before, tmp_path / 'snap')
+    loaded = engine.read_snapshot(tmp_path / 'snap')
+    ledger = NumpyEngine(loaded.accounts, loaded.transactions)
+    ledger.apply_batch(rows[1000:])
+    expected = engine.Engine(fixed=True)
+    expected.apply_batch(rows)
+    assert report(ledger) == report(expected)
+
+def test_main_numpy(monkeypatch, capsys):
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--numpy',
+                                         os.path.join(basepath, 'noheader.csv')])
+    engine.main()
+    assert capsys.readouterr().out.splitlines()[1:] == ['1, 4.0000, 0.0000, 4.0000, False',
+                                                        '2, 8.0000, 0.0000, 8.0000, False',
+                                                        '3, 0.0000, 10.0000, 10.0000, False',
+                                                        '4, 0.0000, 0.0000, 0.0000, True']
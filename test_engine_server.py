@@ -0,0 +1,107 @@
+import pytest, os, sys, asyncio
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, basepath)
+import payment_engine
+import engine_server
+from engine_wal import DurableEngine
+
+def test_parse_line():
+    assert engine_server.parse_line('deposit, 1, 2, 3.5') == ('deposit', '1', '2', '3.5')
+    assert engine_server.parse_line('dispute,1,2') == ('dispute', '1', '2', '')
+    assert engine_server.parse_line('{"type": "deposit", "client": 1, "tx": 2, "amount": 3.5}') == \
+           ('deposit', '1', '2', '3.5')
+    assert engine_server.parse_line('{"query": "balance", "client": 1}') == ('balance', '1', '', '')
+
+async def converse(tmp_path, requests, batch_size=2, engine=None):
+    if engine is None:
+        engine = payment_engine.Engine(fixed=True)
+    ledger = engine_server.LedgerServer(engine, batch_size=batch_size, queue_size=2)
+    path = str(tmp_path / 'engine.sock')
+    server = await ledger.start(path=path)
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(''.join(f'{request}\n' for request in requests).encode())
+    replies = [(await reader.readline()).decode().rstrip('\n') for _ in requests]
+    writer.close()
+    server.close()
+    server.applier.cancel()
+    return engine, replies
+
+def test_server_applies_rows_and_answers_in_order(tmp_path):
+    engine, replies = asyncio.run(converse(tmp_path, [
+        'deposit,1,1,10.0',
+        '{"type": "withdrawal", "client": 1, "tx": 2, "amount": "2.5"}',
+        'balance,1',
+        'deposit,1,3,-1',
+        'refund,1,4,1.0',
+        'deposit,2,4,1.0',
+        'dispute,2,4',
+        '{"query": "balance", "client": 2}',
+        'balance,3',
+    ]))
+    assert replies == ['ok', 'ok', '1, 7.5000, 0.0000, 7.5000, False',
+                       "error: invalid amount '-1'", "error: unknown transaction type 'refund'",
+                       'ok', 'ok', '2, 0.0000, 1.0000, 1.0000, False', 'error: unknown client 3']
+    assert list(engine.accounts) == [1, 2]
+
+def test_server_rejects_ids_outside_u32(tmp_path):
+    engine, replies = asyncio.run(converse(tmp_path, [
+        'deposit,1,5000000000,1.0',
+        'deposit,1,-1,1.0',
+        'deposit,4294967296,1,1.0',
+        'deposit,1,1,1.0',
+        'balance,1',
+    ]))
+    assert replies == ['error: tx 5000000000 is not a u32', 'error: tx -1 is not a u32',
+                       'error: client 4294967296 is not a u32', 'ok',
+                       '1, 1.0000, 0.0000, 1.0000, False']
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_server_rejects_amounts_outside_int64(tmp_path, fixed):
+    engine, replies = asyncio.run(converse(tmp_path, [
+        'deposit,1,1,1e20',
+        'deposit,1,1,922337203685477.5808',
+        'deposit,1,1,5',
+        'deposit,1,2,922337203685477.5807',
+    ], engine=payment_engine.Engine(fixed)))
+    assert replies == ["error: invalid amount '1e20'",
+                       "error: invalid amount '922337203685477.5808'", 'ok', 'ok']
+    assert engine.transactions[1].amount == (50000 if fixed else 5)
+
+class FakeWriter():
+    def __init__(self):
+        self.replies = []
+
+    def is_closing(self):
+        return False
+
+    def write(self, data):
+        self.replies.append(data.decode().rstrip('\n'))
+
+def test_applier_survives_a_failing_row():
+    engine = payment_engine.Engine(fixed=True)
+    ledger = engine_server.LedgerServer(engine)
+    writer = FakeWriter()
+    # Rows that skip validate(), as if it had missed something
+    ledger.apply([(writer, ('deposit', '1', '1', '1.0')),
+                  (writer, ('deposit', '1', '5000000000', '1.0')),
+                  (writer, ('deposit', '1', '2', '2.0')),
+                  (writer, ('balance', '1', '', ''))])
+    assert writer.replies == ['ok', 'error: tx id 5000000000 is not a u32', 'ok',
+                              '1, 3.0000, 0.0000, 3.0000, False']
+
+def test_server_with_wal(tmp_path):
+    wal = str(tmp_path / 'wal')
+    with DurableEngine(wal, fixed=True, sync_every=2, fsync=False) as durable:
+        _, replies = asyncio.run(converse(tmp_path, [
+            'deposit,1,1,10.0',
+            'withdrawal,1,2,2.5',
+            'deposit,1,3,-1',
+            'dispute,1,1',
+            'balance,1',
+        ], engine=durable))
+    assert replies == ['ok', 'ok', "error: invalid amount '-1'", 'ok',
+                       '1, -2.5000, 10.0000, 7.5000, False']
+    with DurableEngine(wal, fixed=True) as recovered:
+        assert recovered.rows == 3
+        assert str(recovered.accounts[1]) == '1, -2.5000, 10.0000, 7.5000, False'
@@ -0,0 +1,107 @@
+import pytest, os, sys, json
+from decimal import Decimal
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, basepath)
+import payment_engine as engine
+from engine_store import SpillStore
+from test_engine import random_rows
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_matches_transaction_store(fixed):
+    rows = random_rows(5000)
+    expected = engine.Engine(fixed)
+    expected.apply_batch(rows)
+    store = SpillStore(fixed=fixed, cache_size=100)
+    ledger = engine.Engine(fixed, transactions=store)
+    ledger.apply_batch(rows)
+    assert [str(acct) for acct in ledger.accounts.values()] == \
+           [str(acct) for acct in expected.accounts.values()]
+    assert len(store) == len(expected.transactions)
+    assert store.spilled > 0 and store.misses > 0
+    store.close()
+    assert not os.path.exists(store.path)
+
+def test_lookups_fall_through_to_disk(tmp_path):
+    store = SpillStore(str(tmp_path / 'spill.db'), cache_size=10)
+    for tx_id in range(100):
+        store.add(tx_id, 'deposit', tx_id % 7, Decimal(f'{tx_id}.5'))
+    assert store.stats()['cached'] <= 10 and store.spilled >= 90
+    stored = store[3]
+    assert (stored.tx_type, stored.client_id, stored.amount) == ('deposit', 3, Decimal('3.5'))
+    assert store.stats()['misses'] == 1
+    store.get(3)
+    assert store.stats()['hits'] == 1 and store.stats()['hit_rate'] == 0.5
+    assert 99 in store and 100 not in store and store.get(100) is None
+    with pytest.raises(KeyError):
+        store[100]
+    with pytest.raises(ValueError):
+        store.add(-1, 'deposit', 1, Decimal(1))
+    store.close()
+    assert not os.path.exists(tmp_path / 'spill.db')
+
+def test_existing_file_is_not_replaced_unless_asked(tmp_path, monkeypatch):
+    path = tmp_path / 'precious.db'
+    path.write_text('keep me')
+    with pytest.raises(FileExistsError):
+        SpillStore(str(path))
+    assert path.read_text() == 'keep me'
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--spill', str(path),
+                                         os.path.join(basepath, 'noheader.csv')])
+    with pytest.raises(SystemExit, match='pass --overwrite-spill'):
+        engine.main()
+    assert path.read_text() == 'keep me'
+    store = SpillStore(str(path), overwrite=True)
+    store.add(1, 'deposit', 1, Decimal(1))
+    store.close()
+    with pytest.raises(FileExistsError):
+        SpillStore(str(tmp_path), overwrite=True)
+
+def test_recently_used_stay_cached():
+    store = SpillStore(fixed=True, cache_size=20)
+    store.add(0, 'withdrawal', 1, 5)
+    for tx_id in range(1, 100):
+        store.get(0)
+        store.add(tx_id, 'deposit', 1, tx_id)
+    assert store.get(0).tx_type == 'withdrawal'
+    assert store.misses == 0
+    store.close()
+
+def test_main_spill_metrics(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--fixed', '--spill',
+                                         str(tmp_path / 'spill.db'), '--cache-size', '1',
+                                         '--metrics', 'json', '--metrics-out',
+                                         str(tmp_path / 'metrics.json'),
+                                         os.path.join(basepath, 'noheader.csv')])
+    engine.main()
+    assert capsys.readouterr().out.splitlines()[1:] == ['1, 4.0000, 0.0000, 4.0000, False',
+                                                        '2, 8.0000, 0.0000, 8.0000, False',
+                                                        '3, 0.0000, 10.0000, 10.0000, False',
+                                                        '4, 0.0000, 0.0000, 0.0000, True']
+    gauges = json.loads((tmp_path / 'metrics.json').read_text())['gauges']
+    assert gauges['tx_cache_spilled'] > 0
+    assert gauges['tx_cache_hits'] + gauges['tx_cache_misses'] > 0
+
+def test_main_spill_file_is_removed_so_reruns_work(tmp_path, monkeypatch, capsys):
+    path = tmp_path / 'spill.db'
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--spill', str(path),
+                                         '--cache-size', '1',
+                                         os.path.join(basepath, 'noheader.csv')])
+    engine.main()
+    first = capsys.readouterr().out
+    assert not path.exists()
+    engine.main()
+    assert capsys.readouterr().out == first
+    assert not path.exists()
+
+def test_dispute_state_survives_spilling():
+    store = SpillStore(fixed=True, cache_size=10)
+    ledger = engine.Engine(True, transactions=store)
+    ledger.apply_batch([('deposit', '1', '1', '10'), ('dispute', '1', '1', '')])
+    ledger.apply_batch([('deposit', '2', str(tx_id), '1') for tx_id in range(2, 100)])
+    assert 1 not in store._cache
+    assert ledger.state(1) == engine.DISPUTED
+    assert ledger.dispute(1, 1) == engine.REJECT_ALREADY_DISPUTED
+    assert ledger.resolve(1, 1) is None
+    assert str(ledger.accounts[1]) == '1, 10.0000, 0.0000, 10.0000, False'
+    store.close()
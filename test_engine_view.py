@@ -0,0 +1,88 @@
+import pytest, os, sys, json, socket, threading
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, basepath)
+import payment_engine as engine
+from engine_view import LedgerView, serve_queries
+from test_engine import random_rows
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_records_match_accounts(fixed):
+    rows = random_rows(3000)
+    view = LedgerView(engine.Engine(fixed), batch_size=100)
+    view.apply_batch(rows)
+    accounts = view.engine.accounts
+    _, records = view.balances(sorted(accounts))
+    assert [view.format(record) for record in records] == \
+        [str(accounts[client_id]) for client_id in sorted(accounts)]
+    totals = view.totals()
+    assert totals['clients'] == len(accounts)
+    assert totals['locked'] == sum(acct.locked for acct in accounts.values())
+    assert totals['total_held'] == sum(acct.held for acct in accounts.values())
+    assert view.balance(999) is None
+
+def test_publishes_existing_accounts():
+    ledger = engine.Engine(True)
+    ledger.apply_batch([('deposit', '1', '1', '2.5')])
+    view = LedgerView(ledger)
+    assert view.format(view.balance(1)) == '1, 2.5000, 0.0000, 2.5000, False'
+
+def test_readers_see_batch_boundaries():
+    rows = random_rows(20000, seed=3)
+    view = LedgerView(engine.Engine(True), batch_size=50)
+    clients = list(range(1, 21))
+    done, failures = threading.Event(), []
+
+    def read():
+        while not done.is_set():
+            version, records = view.balances(clients)
+            records = [record for record in records if record is not None]
+            if any(available + held != total for _, available, held, total, _ in records):
+                failures.append(version)
+            totals = view.totals()
+            if totals['version'] == version and \
+                    totals['total_held'] != sum(record[2] for record in records):
+                failures.append(version)
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    try:
+        view.apply_batch(rows)
+    finally:
+        done.set()
+        reader.join()
+    assert failures == []
+
+def test_socket_queries(tmp_path):
+    view = LedgerView(engine.Engine(True))
+    view.apply_batch([('deposit', '1', '1', '2.5'), ('deposit', '2', '2', '1'),
+                      ('dispute', '2', '2', '')])
+    path = str(tmp_path / 'query.sock')
+    server = serve_queries(view, path)
+    try:
+        with socket.socket(socket.AF_UNIX) as sock:
+            sock.connect(path)
+            sock.sendall(b'balance,1,3\ntotals\nbogus\n')
+            answers = sock.makefile()
+            lines = [answers.readline().strip() for _ in range(4)]
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert lines[:2] == ['1, 2.5000, 0.0000, 2.5000, False', 'error: unknown client 3']
+    assert json.loads(lines[2]) == {'version': view.version, 'clients': 2, 'locked': 0,
+                                    'total_held': '1.0000'}
+    assert lines[3].startswith('error: unknown query')
+
+def test_serve_queries_only_replaces_sockets(tmp_path):
+    view = LedgerView(engine.Engine(True))
+    path = tmp_path / 'report.csv'
+    path.write_text('keep me')
+    with pytest.raises(FileExistsError, match='not a socket'):
+        serve_queries(view, str(path))
+    assert path.read_text() == 'keep me'
+    path = str(tmp_path / 'query.sock')
+    for _ in range(2):
+        # The second time replaces the socket the first one left behind
+        server = serve_queries(view, path)
+        server.shutdown()
+        server.server_close()
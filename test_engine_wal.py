@@ -0,0 +1,114 @@
+import pytest, os, sys
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, basepath)
+import payment_engine as engine
+import engine_wal
+from engine_wal import DurableEngine
+from test_engine import random_rows
+
+def report(accounts):
+    return [str(acct) for acct in accounts.values()]
+
+def full_run(rows, fixed):
+    ledger = engine.Engine(fixed)
+    ledger.apply_batch(rows)
+    return report(ledger.accounts)
+
+@pytest.mark.parametrize('fixed', [False, True])
+@pytest.mark.parametrize('compact_every', [0, 500])
+def test_recovery_matches_full_run(tmp_path, fixed, compact_every):
+    rows = random_rows(2000)
+    with DurableEngine(str(tmp_path), fixed, sync_every=64, compact_every=compact_every) as ledger:
+        ledger.apply_batch(rows[:1200])
+    with DurableEngine(str(tmp_path), fixed, sync_every=64, compact_every=compact_every) as ledger:
+        assert ledger.rows == 1200
+        assert report(ledger.accounts) == full_run(rows[:1200], fixed)
+        ledger.apply_batch(rows[1200:])
+    recovered = DurableEngine(str(tmp_path), fixed)
+    assert recovered.rows == 2000
+    assert report(recovered.accounts) == full_run(rows, fixed)
+    recovered.close()
+
+def test_checkpoint_removes_old_generations(tmp_path):
+    with DurableEngine(str(tmp_path), sync_every=10, compact_every=100, fsync=False) as ledger:
+        ledger.apply_batch(random_rows(1000))
+        assert ledger.generation > 1
+    assert sorted(os.listdir(tmp_path)) == [f'snapshot-{ledger.generation:08d}',
+                                            f'wal-{ledger.generation:08d}']
+
+def test_torn_frame_is_dropped(tmp_path):
+    rows = random_rows(300)
+    with DurableEngine(str(tmp_path), True, sync_every=100) as ledger:
+        ledger.apply_batch(rows)
+    log = tmp_path / 'wal-00000001'
+    log.write_bytes(log.read_bytes()[:-5])
+    with DurableEngine(str(tmp_path), True) as ledger:
+        assert ledger.rows == 200
+        assert report(ledger.accounts) == full_run(rows[:200], True)
+        ledger.apply_batch(rows[200:])
+    with DurableEngine(str(tmp_path), True) as ledger:
+        assert report(ledger.accounts) == full_run(rows, True)
+
+def test_crash_before_snapshot_replays_previous_generation(tmp_path, monkeypatch):
+    rows = random_rows(400)
+    ledger = DurableEngine(str(tmp_path), True, sync_every=50)
+    ledger.apply_batch(rows[:200])
+    def crash(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(engine_wal, 'write_snapshot', crash)
+    with pytest.raises(OSError):
+        ledger.checkpoint()
+    ledger.close()
+    monkeypatch.undo()
+    with DurableEngine(str(tmp_path), True) as ledger:
+        assert ledger.rows == 200
+        ledger.apply_batch(rows[200:])
+        ledger.checkpoint()
+    with DurableEngine(str(tmp_path), True) as ledger:
+        assert report(ledger.accounts) == full_run(rows, True)
+
+def test_fixed_mismatch_is_refused(tmp_path):
+    with DurableEngine(str(tmp_path), True) as ledger:
+        ledger.apply_batch(random_rows(10))
+        ledger.checkpoint()
+    with pytest.raises(ValueError):
+        DurableEngine(str(tmp_path), False)
+
+def test_main_resume(tmp_path, monkeypatch, capsys):
+    rows = random_rows(1000)
+    path = tmp_path / 'input.csv'
+    path.write_text(''.join(f'{",".join(row)}\n' for row in rows))
+    wal = str(tmp_path / 'wal')
+    # A run that was interrupted after 600 rows
+    with DurableEngine(wal, True, sync_every=100) as ledger:
+        ledger.apply_batch(rows[:600])
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--fixed', '--wal', wal,
+                                         '--resume', str(path)])
+    engine.main()
+    assert capsys.readouterr().out.splitlines()[1:] == full_run(rows, True)
+
+def test_wal_logs_rows_applied_before_a_failure(tmp_path):
+    with DurableEngine(str(tmp_path), True, fsync=False) as durable:
+        with pytest.raises(ValueError):
+            durable.apply_batch([('deposit', '1', '1', '1.0'), ('deposit', '1', '5000000000', '1.0'),
+                                 ('deposit', '1', '2', '1.0')])
+        assert durable.rows == 1
+    with DurableEngine(str(tmp_path), True) as recovered:
+        assert str(recovered.accounts[1]) == '1, 1.0000, 0.0000, 1.0000, False'
+
+def test_rows_with_line_breaking_characters_replay(tmp_path):
+    rows = [('deposit', '1', '1', '1.0'), ('note\x0c', '1', '2', 'x'),
+            ('memo\u2028\x1c\x85', '1', '1', ''), ('deposit', '1', '3', '2.0')]
+    with DurableEngine(str(tmp_path), True, fsync=False) as durable:
+        durable.apply_batch(rows)
+    with DurableEngine(str(tmp_path), True) as recovered:
+        assert recovered.rows == 4
+        assert str(recovered.accounts[1]) == '1, 3.0000, 0.0000, 3.0000, False'
+
+def test_main_refuses_wal_with_numpy(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, 'argv', ['payment_engine.py', '--wal', str(tmp_path), '--numpy',
+                                         os.path.join(basepath, 'noheader.csv')])
+    with pytest.raises(SystemExit):
+        engine.main()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,54 @@
+import pytest, os, sys, json, subprocess, threading
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, basepath)
+import socketserver
+import engine_worker
+
+def cli(args):
+    return subprocess.run([sys.executable, os.path.join(basepath, 'payment_engine.py')] + args,
+                          capture_output=True, check=True).stdout
+
+@pytest.mark.parametrize('args', [['--fixed'], ['--format', 'csv', '--sort'], []])
+def test_run_matches_cli(args):
+    args = [os.path.join(basepath, 'header.csv')] + args
+    assert engine_worker.run(args) == b'ok\n' + cli(args)
+
+def test_run_reports_errors(tmp_path):
+    assert engine_worker.run([str(tmp_path / 'missing.csv')]).startswith(b'error: ')
+    assert engine_worker.run(['--numpy', '--kernel', 'x.csv']).startswith(b'error: ')
+    assert engine_worker.run(['-']) == b'error: stdin input is not supported by the worker\n'
+
+def test_run_refuses_options_that_write(tmp_path):
+    target = tmp_path / 'precious.txt'
+    target.write_text('keep me')
+    csv = os.path.join(basepath, 'header.csv')
+    for args in (['--output', str(target)], [f'--output={target}'], ['--out', str(target)],
+                 ['--spill', str(target), '--overwrite-spill'], ['--query-socket', str(target)],
+                 ['--metrics', 'json', '--metrics-out', str(target)], ['-h']):
+        answer = engine_worker.run([csv] + args)
+        assert answer.startswith(b'error: ') and b'not supported by the worker' in answer
+    assert target.read_text() == 'keep me'
+
+def test_run_returns_metrics_after_the_report():
+    csv = os.path.join(basepath, 'header.csv')
+    answer = engine_worker.run([csv, '--metrics', 'json'])
+    report = cli([csv])
+    assert answer.startswith(b'ok\n' + report)
+    assert json.loads(answer[len(report) + 3:])['rows']['deposit'] > 0
+
+def test_serves_over_socket(tmp_path):
+    path = str(tmp_path / 'worker.sock')
+    server = socketserver.UnixStreamServer(path, engine_worker.WorkerHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        csv = os.path.join(basepath, 'noheader.csv')
+        first = engine_worker.request(path, [csv, '--fixed'])
+        assert engine_worker.request(path, [csv, '--fixed']) == first
+        assert first == b'ok\n' + cli([csv, '--fixed'])
+        assert engine_worker.request(path, ['--no-such-option']).startswith(b'error: ')
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,75 @@
+import pytest, os, sys, io
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, basepath)
+import payment_engine as engine
+import fuzz_engine
+
+def test_generate_is_valid_and_deterministic():
+    rows = fuzz_engine.generate(2000, seed=5)
+    assert rows == fuzz_engine.generate(2000, seed=5)
+    amounts = []
+    for _type, client, tx, amount in rows:
+        assert int(client) > 0 and 0 <= int(tx) < 2**32
+        if _type in engine.RECORDED:
+            amounts.append(engine.parse_amount(amount))
+        elif _type in engine.TYPES:
+            assert amount == ''
+        else:
+            assert _type in fuzz_engine.UNKNOWN_TYPES
+    assert {_type for _type, _, _, _ in rows} - engine.TYPES
+    assert min(amounts) < 0 and 0 in amounts
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_reference_model(fixed):
+    rows = [('deposit', '2', '1', '5.5'), ('deposit', '1', '2', '2'),
+            ('refund', '1', '2', '1'), ('Deposit', '3', '3', '1'), ('dispute', '4', '9', ''),
+            ('withdrawal', '1', '4', '3'), ('withdrawal', '1', '5', '-1'),
+            ('deposit', '2', '2', '100'), ('dispute', '1', '5', ''),
+            ('dispute', '2', '1', ''), ('resolve', '2', '1', ''), ('dispute', '2', '1', ''),
+            ('chargeback', '2', '1', ''), ('deposit', '2', '6', '1'), ('dispute', '1', '1', '')]
+    if fixed:
+        expected = ['2, 0.0000, 0.0000, 0.0000, True', '1, 3.0000, 0.0000, 3.0000, False']
+    else:
+        expected = ['2, 0.0, 0.0, 0.0, True', '1, 3, 0, 3, False']
+    assert fuzz_engine.reference(rows, fixed) == expected
+    assert fuzz_engine.run(rows, 'engine', fixed) == expected
+
+@pytest.mark.parametrize('fixed', [False, True])
+def test_backends_agree(fixed):
+    rows = fuzz_engine.generate(1500, seed=1)
+    expected = fuzz_engine.reference(rows, fixed)
+    for name in ('process_row', 'engine', 'chunk', 'spill', 'snapshot', 'view') + (('kernel',) if fixed else ()):
+        assert fuzz_engine.run(rows, name, fixed) == expected, name
+
+def test_order_is_compared(monkeypatch):
+    # A backend that reports the right accounts, sorted
+    def by_client(rows, fixed):
+        ledger = engine.Engine(fixed)
+        ledger.apply_batch(rows)
+        return fuzz_engine.report(sorted(ledger.accounts.values(), key=lambda acct: acct.client_id))
+    monkeypatch.setitem(fuzz_engine.BACKENDS, 'by_client', by_client)
+    mismatches, _ = fuzz_engine.fuzz(1, 200, ['by_client'], log=io.StringIO())
+    assert len(mismatches) == 2
+    assert sorted(fuzz_engine.run(mismatches[0][3], 'by_client', False)) == \
+        sorted(fuzz_engine.reference(mismatches[0][3], False))
+
+def test_mismatch_is_shrunk(tmp_path, monkeypatch):
+    # A backend that ignores chargebacks
+    def unlocked(rows, fixed):
+        ledger = engine.Engine(fixed)
+        ledger.effects['chargeback'] = lambda client_id, tx_id, amount: None
+        ledger.apply_batch(rows)
+        return fuzz_engine.report(ledger.accounts.values())
+    monkeypatch.setitem(fuzz_engine.BACKENDS, 'unlocked', unlocked)
+    log = io.StringIO()
+    mismatches, throughput = fuzz_engine.fuzz(1, 2000, ['unlocked'], out=str(tmp_path), log=log)
+    assert [(name, fixed) for name, fixed, _, _ in mismatches] == [('unlocked', False),
+                                                                  ('unlocked', True)]
+    minimal = mismatches[0][3]
+    assert len(minimal) <= 3 and minimal[-1][0] == 'chargeback'
+    assert unlocked(minimal, False) != fuzz_engine.reference(minimal, False)
+    assert sorted(os.listdir(tmp_path)) == ['mismatch-unlocked-decimal-0.csv',
+                                            'mismatch-unlocked-fixed-0.csv']
+    assert set(throughput) == {'reference/decimal', 'reference/fixed', 'unlocked/decimal',
+                               'unlocked/fixed'}
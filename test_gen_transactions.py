@@ -0,0 +1,39 @@
+import pytest, os, sys, io
+from collections import Counter
+
+basepath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, basepath)
+import payment_engine
+import gen_transactions
+
+def test_generate_is_deterministic():
+    assert list(gen_transactions.generate(500, seed=3)) == list(gen_transactions.generate(500, seed=3))
+    assert list(gen_transactions.generate(500, seed=3)) != list(gen_transactions.generate(500, seed=4))
+
+def test_generate_ratios_and_skew():
+    rows = list(gen_transactions.generate(20000, clients=100, zipf=1.2, withdrawal=0.2,
+                                          dispute=0.05, resolve=0.02, chargeback=0.01))
+    types = Counter(row[0] for row in rows)
+    assert len(rows) == 20000
+    assert 0.18 < types['withdrawal'] / 20000 < 0.22
+    assert 0.04 < types['dispute'] / 20000 < 0.06
+    assert 0.015 < types['resolve'] / 20000 < 0.025
+    assert 0.005 < types['chargeback'] / 20000 < 0.015
+    clients = Counter(row[1] for row in rows if row[0] == 'deposit')
+    assert clients['1'] > 5 * clients['50']
+
+def test_disputes_refer_to_deposits_of_the_same_client():
+    deposits = {}
+    for _type, client, tx, amount in gen_transactions.generate(5000, dispute=0.1, resolve=0.05):
+        if _type == 'deposit':
+            deposits[tx] = client
+        elif _type != 'withdrawal':
+            assert deposits[tx] == client
+            assert amount == ''
+
+def test_write_csv_round_trips_through_read_rows():
+    rows = list(gen_transactions.generate(100))
+    out = io.StringIO()
+    gen_transactions.write_csv(out, rows)
+    out.seek(0)
+    assert list(payment_engine.read_rows(out)) == rows